@@ -0,0 +1,39 @@
+"""Fails if ZSpotify imports a heavy dependency on startup
+
+Runs `python -X importtime -m zspotify --version` from the root of the
+repository and looks for the modules that are only loaded when needed.
+"""
+from pathlib import Path
+
+import subprocess
+import sys
+
+HEAVY_MODULES = ("librespot", "pydub", "mutagen", "music_tag", "tqdm", "requests", "sqlite3")
+
+
+def main():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "zspotify", "--version"],
+        cwd=Path(__file__).resolve().parent.parent,
+        capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        return 1
+
+    # Lines look like "import time:  self [us] | cumulative | imported package"
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or line.endswith("imported package"):
+            continue
+        imported.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+
+    heavy = [module for module in HEAVY_MODULES if module in imported]
+    if heavy:
+        print(f"Imported on startup: {', '.join(heavy)}")
+        return 1
+    print("No heavy imports on startup")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,27 +1,34 @@
 try:
-    from .zspotify_api import ZSpotifyApi
+    from .journal import RunJournal
+    from .tracing import Profiler, traced, tracer
+    from .zspotify_api import Record, ZSpotifyApi
 except ImportError:
-    from zspotify_api import ZSpotifyApi
+    from journal import RunJournal
+    from tracing import Profiler, traced, tracer
+    from zspotify_api import Record, ZSpotifyApi
 
 from getpass import getpass
 import importlib.metadata as metadata
-from mutagen import id3
 from pathlib import Path
-from threading import Thread
-from tqdm import tqdm
+from threading import Event, Thread
 
 import argparse
+import collections
 import datetime
+import errno
+import itertools
 import json
-import music_tag
 import os
-import requests
+import shutil
+import signal
+import socket
 import sys
 import time
 
 _ANTI_BAN_WAIT_TIME = os.environ.get('ANTI_BAN_WAIT_TIME', 5)
 _ANTI_BAN_WAIT_TIME_ALBUMS = os.environ.get('ANTI_BAN_WAIT_TIME_ALBUMS', 30)
 _LIMIT_RESULTS = os.environ.get('LIMIT_RESULTS', 10)
+_AUDIO_FORMATS = ["mp3", "ogg"]
 
 try:
     __version__ = metadata.version("zspotify")
@@ -29,36 +36,146 @@ except metadata.PackageNotFoundError:
     __version__ = "unknown"
 
 
+def audio_formats(value):
+    """argparse type for a comma separated list of audio formats"""
+    formats = []
+    for audio_format in value.split(","):
+        audio_format = audio_format.strip().lower()
+        if audio_format not in _AUDIO_FORMATS:
+            raise argparse.ArgumentTypeError(
+                f"invalid choice: '{audio_format}' (choose from {', '.join(_AUDIO_FORMATS)})")
+        if audio_format not in formats:
+            formats.append(audio_format)
+    return formats
+
+
+def byte_rate(value):
+    """argparse type for bytes per second, with an optional K, M or G suffix"""
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    value = str(value).strip().lower()
+    try:
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(float(value))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid rate: '{value}' (e.g. 500K or 2M)")
+
+
+class ArchiveEntry(Record):
+    """Archive entry, timestamps are kept as seconds instead of strings
+
+    Entries are saved in the same json format as before."""
+    __slots__ = ("artist", "track_name", "audio_type", "fullpath", "timestamp",
+                 "fullpaths", "isrc", "quality", "bitrate", "placements")
+
+    EPOCH = datetime.datetime(1970, 1, 1)
+    TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    @classmethod
+    def from_json(cls, entry):
+        timestamp = entry.get("timestamp")
+        try:
+            # Local time without a timezone, so no conversion can shift it
+            timestamp = int((datetime.datetime.fromisoformat(timestamp) - cls.EPOCH).total_seconds())
+        except (TypeError, ValueError):
+            pass
+        return cls(sys.intern(entry["artist"]) if entry.get("artist") else entry.get("artist"),
+                   entry.get("track_name"),
+                   sys.intern(entry["audio_type"]) if entry.get("audio_type") else entry.get("audio_type"),
+                   entry.get("fullpath"),
+                   timestamp,
+                   entry.get("fullpaths"),
+                   entry.get("isrc"),
+                   entry.get("quality"),
+                   entry.get("bitrate"),
+                   entry.get("placements"))
+
+    def to_json(self):
+        timestamp = self.timestamp
+        if isinstance(timestamp, int):
+            timestamp = (self.EPOCH + datetime.timedelta(seconds=timestamp)).strftime(self.TIMESTAMP_FORMAT)
+        entry = {"artist": self.artist,
+                 "track_name": self.track_name,
+                 "audio_type": self.audio_type,
+                 "fullpath": self.fullpath,
+                 "timestamp": timestamp}
+        if self.fullpaths:
+            entry["fullpaths"] = self.fullpaths
+        if self.isrc:
+            entry["isrc"] = self.isrc
+        if self.quality:
+            entry["quality"] = self.quality
+        if self.bitrate:
+            entry["bitrate"] = self.bitrate
+        if self.placements:
+            entry["placements"] = self.placements
+        return entry
+
+
 class Archive:
 
     def __init__(self, file):
         self.file = file
-        self.data = self.load()
+        self._data = None
+        self._isrc_index = None
+
+    @property
+    def data(self):
+        """Archive entries, loaded from disk on first access"""
+        if self._data is None:
+            self._data = self.load()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._isrc_index = None
 
     def load(self):
         if self.file.exists():
             with open(self.file, "r") as f:
                 try:
-                    return json.load(f)
+                    # Entries are converted while parsing, so the whole
+                    # archive never exists as dicts
+                    return json.load(f, object_hook=self.decode_entry)
                 except Exception as e:
                     print("Error loading archive: {}".format(e))
                     return {}
         return {}
 
+    @staticmethod
+    def decode_entry(obj):
+        if "fullpath" in obj and "timestamp" in obj:
+            return ArchiveEntry.from_json(obj)
+        return obj
+
     def save(self):
         with open(self.file, "w") as f:
-            json.dump(self.data, f, indent=4)
+            json.dump(self.data, f, indent=4, default=ArchiveEntry.to_json)
 
     def add(self, track_id, artist=None, track_name=None, fullpath=None,
-            audio_type=None, timestamp=None, save=True):
+            audio_type=None, timestamp=None, save=True, fullpaths=None, isrc=None,
+            quality=None, bitrate=None):
+        """Adds or replaces an entry, bitrate is in kbps, the placements of a
+        replaced entry are kept"""
+        placements = self.data[track_id].placements if track_id in self.data else None
         if not timestamp:
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.data[track_id] = {"artist": artist,
-                               "track_name": track_name,
-                               "audio_type": audio_type,
-                               "fullpath": str(fullpath),
-                               "timestamp": timestamp
-                               }
+            timestamp = datetime.datetime.now().strftime(ArchiveEntry.TIMESTAMP_FORMAT)
+        if fullpaths:
+            # One path per audio format
+            fullpaths = {audio_format: str(path) for audio_format, path in fullpaths.items()}
+        self.data[track_id] = ArchiveEntry.from_json({"artist": artist,
+                                                     "track_name": track_name,
+                                                     "audio_type": audio_type,
+                                                     "fullpath": str(fullpath),
+                                                     "timestamp": timestamp,
+                                                     "fullpaths": fullpaths,
+                                                     "isrc": isrc,
+                                                     "quality": quality,
+                                                     "bitrate": bitrate,
+                                                     "placements": placements})
+        if isrc and self._isrc_index is not None and track_id not in self._isrc_index.get(isrc, []):
+            self._isrc_index.setdefault(isrc, []).append(track_id)
         print("Added to archive: {} - {}".format(artist, track_name))
         if save:
             self.save()
@@ -66,13 +183,57 @@ class Archive:
     def get(self, track_id):
         return self.data.get(track_id)
 
+    def add_placement(self, track_id, link_mode, fullpaths):
+        """Records files placed from the files of an entry, links or copies,
+        so they can be placed again when the entry is downloaded again"""
+        entry = self.data[track_id]
+        placement = {"link_mode": link_mode,
+                     "fullpaths": {audio_format: str(path) for audio_format, path in fullpaths.items()}}
+        placements = entry.placements or []
+        if placement not in placements:
+            entry.placements = placements + [placement]
+            self.save()
+
+    def get_placements(self, track_id):
+        """Returns the link mode and paths of the files placed from an entry"""
+        entry = self.get(track_id)
+        if not entry or not entry.get("placements"):
+            return []
+        return [(placement["link_mode"],
+                 {audio_format: Path(path) for audio_format, path in placement["fullpaths"].items()})
+                for placement in entry["placements"]]
+
     def remove(self, track_id):
-        self.data.pop(track_id)
+        entry = self.data.pop(track_id)
+        if self._isrc_index is not None and entry.get("isrc"):
+            self._isrc_index[entry["isrc"]].remove(track_id)
         self.save()
 
+    def find_isrc(self, isrc):
+        """Returns the ids of the archived tracks with the given ISRC, the same
+        recording can have several track ids (album, single, compilation...)"""
+        if self._isrc_index is None:
+            self._isrc_index = {}
+            for track_id, entry in self.data.items():
+                if entry.get("isrc"):
+                    self._isrc_index.setdefault(entry["isrc"], []).append(track_id)
+        return list(self._isrc_index.get(isrc, []))
+
     def exists(self, track_id):
         return track_id in self.data
 
+    def get_paths(self, track_id):
+        """Returns a dict of audio format to path of the files of an entry"""
+        entry = self.get(track_id)
+        if not entry:
+            return {}
+        if entry.get("fullpaths"):
+            return {audio_format: Path(path) for audio_format, path in entry["fullpaths"].items()}
+        if not entry.get("fullpath") or entry["fullpath"] == "None":
+            return {}
+        path = Path(entry["fullpath"])
+        return {path.suffix[1:]: path}
+
     def get_all(self):
         return self.data
 
@@ -110,6 +271,34 @@ class Archive:
     #     self.save()
 
 
+class State:
+    """Small json store for what zspotify remembers between runs"""
+
+    def __init__(self, file):
+        self.file = file
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = {}
+            if self.file.exists():
+                with open(self.file, "r") as f:
+                    try:
+                        self._data = json.load(f)
+                    except Exception as e:
+                        print("Error loading state: {}".format(e))
+        return self._data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+        with open(self.file, "w") as f:
+            json.dump(self.data, f, indent=4)
+
+
 # UTILS
 class Style:
     RED = "\033[31m"
@@ -124,33 +313,107 @@ class ZSpotify:
         self.SANITIZE_CHARS = ["\\", "/", ":", "*", "?", "'", "<", ">", '"']
         self.SEPARATORS = [",", ";"]
         self.args = self.parse_args()
+        # Journal of the run, to resume it if it is interrupted
+        self.journal = RunJournal(Path(self.args.config_dir) / self.journal_name())
+        self.journal_job = None
+        # Metadata fetched ahead of downloads by lookahead
+        self.resolved_infos = {}
+        if self.args.resume:
+            resumable = [journal for journal in self.previous_journals() if journal.resumable()]
+            if resumable:
+                self.journal = resumable[-1]
+                # Same options as the interrupted run
+                self.args = self.parse_args(self.journal.argv + ["--resume"])
+            else:
+                print("No interrupted run to resume")
         self.zs_api = ZSpotifyApi(
             sanitize=self.SANITIZE_CHARS,
             config_dir=self.args.config_dir,
-            music_format=self.args.audio_format,
+            music_format=self.args.audio_format[0],
             force_premium=self.args.force_premium,
             anti_ban_wait_time=self.args.antiban_time,
             credentials=self.args.credentials_file,
-            limit=self.args.limit)
+            limit=self.args.limit,
+            # Upgrades look for downloads below the current account, read it again
+            account_cache_ttl=0 if self.args.upgrade else 24 * 60 * 60,
+            replaygain=self.args.replaygain,
+            http_cache_dir=Path(self.args.config_dir) / "http_cache" if self.args.http_cache else None,
+            max_bandwidth=self.args.max_bandwidth,
+            max_api_bandwidth=self.args.max_api_bandwidth,
+            parallel_ranges=self.args.parallel_ranges)
 
         # User defined directories
         self.config_dir = Path(self.args.config_dir)
         self.download_dir = Path(self.args.download_dir)
         self.music_dir = Path(self.args.music_dir)
         self.episodes_dir = Path(self.args.episodes_dir)
+        self.scratch_dir = Path(self.args.scratch_dir) if self.args.scratch_dir else None
 
+        self.audio_formats = self.args.audio_format
         self.album_in_filename = self.args.album_in_filename
         self.antiban_album_time = self.args.antiban_album
         self.not_skip_existing = self.args.not_skip_existing
         self.skip_downloaded = self.args.skip_downloaded
+        self.tag_in_place = self.args.tag_in_place
+        self.link_mode = self.args.link_mode
+        self.genres = not self.args.no_genres
+        # Jobs collected instead of downloaded in --plan mode
+        self.plan = [] if self.args.plan or self.args.plan_file else None
+        # Loudness analyses of the album being downloaded, for album gain
+        self.album_loudness = None
         self.archive_file = self.args.config_dir / self.args.archive
         self.archive = Archive(self.archive_file)
+        self.state = State(self.config_dir / "state.json")
+
+        self.job_queue = None
+        if self.args.job_queue:
+            # sqlite3 is only loaded by the runs that share a queue
+            try:
+                from .job_queue import SQLiteJobQueue
+            except ImportError:
+                from job_queue import SQLiteJobQueue
+            self.job_queue = SQLiteJobQueue(self.args.job_queue,
+                                            lease_time=self.args.lease_time)
+        self.worker_id = self.args.worker_id or f"{socket.gethostname()}-{os.getpid()}"
+
+        if self.args.bandwidth_file:
+            self.load_bandwidth()
+            # Not available on Windows
+            if hasattr(signal, "SIGHUP"):
+                # The handler runs on the main thread, possibly while it holds
+                # the lock of a limiter, so the file is reloaded by another thread
+                self.bandwidth_reload = Event()
+                Thread(target=self.reload_bandwidth, daemon=True).start()
+                signal.signal(signal.SIGHUP, lambda signum, frame: self.bandwidth_reload.set())
+
+    def reload_bandwidth(self):
+        """Loads --bandwidth-file again every time SIGHUP is received"""
+        while True:
+            self.bandwidth_reload.wait()
+            self.bandwidth_reload.clear()
+            self.load_bandwidth()
+
+    def load_bandwidth(self):
+        """Applies the limits of --bandwidth-file, e.g. {"max_bandwidth": "2M"},
+        a limit that is missing or null is removed"""
+        try:
+            with open(self.args.bandwidth_file, "r") as f:
+                limits = json.load(f)
+            max_bandwidth = limits.get("max_bandwidth")
+            max_api_bandwidth = limits.get("max_api_bandwidth")
+            self.zs_api.bandwidth.rate = byte_rate(max_bandwidth) if max_bandwidth else None
+            self.zs_api.api_bandwidth.rate = byte_rate(max_api_bandwidth) if max_api_bandwidth else None
+        except (OSError, ValueError, AttributeError, argparse.ArgumentTypeError) as e:
+            print(f"Unable to load {self.args.bandwidth_file}: {e}")
+            return
+        print(f"Bandwidth limits: {self.zs_api.bandwidth.rate or 'none'} B/s for audio, "
+              f"{self.zs_api.api_bandwidth.rate or 'none'} B/s for the API")
 
-    def parse_args(self):
+    def parse_args(self, argv=None):
         parser = argparse.ArgumentParser()
         parser.add_argument(
             "search",
-            help="Searches for a track, album, artist or playlist or download by url",
+            help="Searches for a track, album, artist, playlist, show or episode or download by url",
             const=None,
             nargs="?")
         parser.add_argument(
@@ -167,6 +430,32 @@ class ZSpotify:
             "-ls", "--liked-songs",
             help="Downloads your liked songs",
             action="store_true")
+        parser.add_argument(
+            "--incremental",
+            help="With --liked-songs, stop at the first song already downloaded by a previous sync",
+            action="store_true", default=False)
+        parser.add_argument(
+            "--watch",
+            help="Stay running and download new episodes and tracks of the shows and playlists "
+                 "listed in this json file")
+        parser.add_argument(
+            "--watch-interval",
+            help="Default seconds between polls of a watched show or playlist",
+            default=3600, type=int)
+        parser.add_argument(
+            "--resume",
+            help="Continue the last run where it was interrupted, with the same options, "
+                 "and retry its failed downloads",
+            action="store_true", default=False)
+        parser.add_argument(
+            "--discard-journal",
+            help="Start a new run even though an earlier one was interrupted",
+            action="store_true", default=False)
+        parser.add_argument(
+            "--upgrade",
+            help="Download again, in place, the archived files encoded below the bitrate of the "
+                 "current account",
+            action="store_true", default=False)
         parser.add_argument(
             "-pl", "--playlist",
             help="Download playlist by id or url")
@@ -206,14 +495,23 @@ class ZSpotify:
             "--episodes-dir",
             help="Folder to save the downloaded episodes files",
             default=Path.home() / "Music" / "ZSpotify Podcast")
+        parser.add_argument(
+            "--scratch-dir",
+            help="Folder on fast local storage to encode and tag files in before moving them "
+                 "to the music and episodes folders")
+        parser.add_argument(
+            "--profile",
+            help="Profile the run and save the stats to this file (e.g. run.prof), and a timeline "
+                 "of every download to the same name with a .trace.json suffix")
         parser.add_argument(
             "-v", "--version",
             help="Shows the current version of ZSpotify and exit",
             action="store_true")
         parser.add_argument(
             "-af", "--audio-format",
-            help="Audio format to download the tracks",
-            default="mp3", choices=["mp3", "ogg"])
+            help="Audio format(s) to download the tracks, e.g. mp3 or mp3,ogg. "
+                 "With several formats each one is saved in its own folder",
+            default=["mp3"], type=audio_formats)
         parser.add_argument(
             "--album-in-filename",
             help="Adds the album name to the filename",
@@ -231,10 +529,53 @@ class ZSpotify:
             "--limit",
             help="limit",
             default=_LIMIT_RESULTS, type=int)
+        parser.add_argument(
+            "--http-cache",
+            help="Cache Spotify API responses in the config folder and revalidate them with conditional requests",
+            action="store_true", default=False)
+        parser.add_argument(
+            "--prefetch",
+            help="Number of upcoming tracks whose streams are opened while the current one downloads, "
+                 "0 to disable",
+            default=2, type=int)
+        parser.add_argument(
+            "--parallel-ranges",
+            help="Number of 128 KiB chunks of a file fetched at the same time",
+            default=4, type=int)
+        parser.add_argument(
+            "--max-bandwidth",
+            help="Maximum download rate of audio in bytes per second shared by all downloads, e.g. 2M",
+            type=byte_rate)
+        parser.add_argument(
+            "--max-api-bandwidth",
+            help="Maximum download rate of Spotify API responses and covers in bytes per second, e.g. 200K",
+            type=byte_rate)
+        parser.add_argument(
+            "--bandwidth-file",
+            help="Json file with max_bandwidth and max_api_bandwidth, read at start and reloaded on "
+                 "SIGHUP to change the limits while running")
         parser.add_argument(
             "-f", "--force-premium",
             help="Force premium account",
             action="store_true", default=False)
+        parser.add_argument(
+            "--replaygain",
+            help="Analyze loudness while converting and write ReplayGain track and album tags",
+            action="store_true", default=False)
+        parser.add_argument(
+            "--no-genres",
+            help="Do not look up the genres of the artists for the genre tag",
+            action="store_true", default=False)
+        parser.add_argument(
+            "--tag-in-place",
+            help="Tag files after converting them instead of while encoding, rewrites every file",
+            action="store_true", default=False)
+        parser.add_argument(
+            "--link-mode",
+            help="Download tracks in several playlists only once: later copies are hardlinks, "
+                 "reflinks or m3u8 playlist entries pointing at the first one. A hardlink to another "
+                 "release of the same recording keeps the tags of that release",
+            choices=["hardlink", "reflink", "m3u8"])
         parser.add_argument(
             "-ns",
             "--not-skip-existing",
@@ -254,8 +595,32 @@ class ZSpotify:
             default=Path.home() / ".zspotify" / "credentials.json")
         parser.add_argument("-bd", "--bulk-download",
                             help="Bulk download from file with urls")
+        parser.add_argument(
+            "--plan",
+            help="Only resolve what would be downloaded and show the size and time it would take",
+            action="store_true", default=False)
+        parser.add_argument(
+            "--plan-file",
+            help="Save the plan as json to this file, implies --plan")
+        parser.add_argument(
+            "--plan-rate",
+            help="Download speed in bytes per second used to estimate the plan time",
+            default=1024 * 1024, type=int)
+        parser.add_argument(
+            "--execute-plan",
+            help="Download the tracks of a plan saved with --plan-file")
+        parser.add_argument(
+            "--job-queue",
+            help="Shared job queue database, lets several instances split the same download")
+        parser.add_argument(
+            "--worker-id",
+            help="Name of this instance in the job queue, defaults to hostname-pid")
+        parser.add_argument(
+            "--lease-time",
+            help="Seconds a job stays claimed by a worker without a heartbeat",
+            default=300, type=int)
 
-        return parser.parse_args()
+        return parser.parse_args(argv)
 
     def splash(self):
         """Displays splash screen"""
@@ -289,6 +654,8 @@ class ZSpotify:
 
     def antiban_wait(self, seconds: int = 5):
         """ Pause between albums for a set number of seconds """
+        if self.plan is not None:
+            return
         for i in range(seconds)[::-1]:
             print(
                 "\rWait for Next Download in %d second(s)..." %
@@ -315,6 +682,7 @@ class ZSpotify:
         password = getpass()
         return self.zs_api.login(username, password)
 
+    @traced("set_audio_tags")
     def set_audio_tags(self,
                        filename,
                        artists=None,
@@ -325,8 +693,18 @@ class ZSpotify:
                        track_number=None,
                        track_id_str=None,
                        album_artist=None,
-                       image_url=None):
-        """sets music_tag metadata using mutagen if possible"""
+                       genre=None,
+                       image_url=None,
+                       replaygain=None,
+                       image=None):
+        """sets music_tag metadata using mutagen if possible
+
+        replaygain is a dict of ReplayGain tag name to value, e.g.
+        {"REPLAYGAIN_TRACK_GAIN": "-6.50 dB"}. image is the cover as bytes,
+        otherwise it is downloaded from image_url"""
+        import music_tag
+        from mutagen import id3
+
         artist = artists
 
         if artist is not None and album_artist is None:
@@ -375,8 +753,8 @@ class ZSpotify:
                 tags["TPE2"] = id3.TPE2(
                     encoding=3, text=album_artist
                 )
-            if image_url is not None:
-                albumart = requests.get(image_url).content if image_url else None
+            if image is not None or image_url is not None:
+                albumart = image or self.get_cover(image_url)
                 if albumart:
                     # APIC Attached (or linked) Picture.
                     tags["APIC"] = id3.APIC(
@@ -386,7 +764,15 @@ class ZSpotify:
                         desc="0",
                         data=albumart,
                     )
-            # TCON Genre - TODO
+            if replaygain is not None:
+                for key, value in replaygain.items():
+                    # TXXX User defined text information frame
+                    tags["TXXX:" + key] = id3.TXXX(
+                        encoding=3, desc=key, text=value
+                    )
+            if genre is not None:
+                # TCON Content type (genre)
+                tags["TCON"] = id3.TCON(encoding=3, text=genre)
             tags.save()
         # Use music_tag for other file formats
         else:
@@ -405,12 +791,74 @@ class ZSpotify:
                 tags["tracknumber"] = track_number
             if track_id_str is not None:
                 tags["comment"] = "https://open.spotify.com/track/" + track_id_str
-            if image_url is not None:
-                albumart = requests.get(image_url).content if image_url else None
+            if genre is not None:
+                tags["genre"] = genre
+            if image is not None or image_url is not None:
+                albumart = image or self.get_cover(image_url)
                 if albumart:
                     tags["artwork"] = albumart
+            if replaygain is not None:
+                # music_tag has no ReplayGain fields, set the raw comments
+                for key, value in replaygain.items():
+                    tags.mfile[key.lower()] = value
             tags.save()
 
+    def encode_tags(self,
+                    artists=None,
+                    name=None,
+                    album_name=None,
+                    release_year=None,
+                    disc_number=None,
+                    track_number=None,
+                    track_id_str=None,
+                    album_artist=None,
+                    genre=None):
+        """Returns the tags of set_audio_tags as ffmpeg metadata, for the encoder"""
+        if artists is not None and album_artist is None:
+            album_artist = artists
+        comment = None
+        if track_id_str is not None:
+            comment = "https://open.spotify.com/track/" + track_id_str
+        tags = {"artist": artists,
+                "title": name,
+                "album": album_name,
+                "date": release_year,
+                "disc": disc_number,
+                "track": track_number,
+                "comment": comment,
+                "album_artist": album_artist,
+                "genre": genre}
+        return {key: str(value) for key, value in tags.items() if value is not None}
+
+    def get_cover(self, image_url):
+        """Returns the bytes of the cover image"""
+        if image_url is None:
+            return None
+        import requests
+        cover = requests.get(image_url).content
+        self.zs_api.api_bandwidth.consume(len(cover))
+        return cover
+
+    def track_tags(self, track):
+        """Returns the set_audio_tags arguments of a track"""
+        return {"artists": track['artist_name'],
+                "name": track['audio_name'],
+                "album_name": track['album_name'],
+                "release_year": track['release_year'],
+                "disc_number": track['disc_number'],
+                "track_number": track['audio_number'],
+                "track_id_str": track['scraped_song_id'],
+                "genre": self.zs_api.conv_artist_format(track['genres']) if track.get('genres') else None}
+
+    def tag_outputs(self, fullpaths, tags, image_url=None, cover=None, replaygain=None):
+        """Writes the tags the encoder did not write, in place"""
+        for audio_format, output_path in fullpaths.items():
+            if self.tag_in_place:
+                self.set_audio_tags(output_path, image_url=image_url, replaygain=replaygain, **tags)
+            elif audio_format != "mp3" and cover:
+                # Only the mp3 encoder can embed the cover
+                self.set_audio_tags(output_path, image=cover)
+
     # ARCHIVE
     def archive_migration(self):
         """Migrates the old archive to the new one"""
@@ -495,12 +943,844 @@ class ZSpotify:
 
         return fullpath, filename
 
+    def track_paths(self, track, path=None, caller=None):
+        """Returns the output paths of a track in every audio format and its filename"""
+        # Sanitize and set full path once
+        fullpath, filename = self.generate_filename(caller, track['audio_name'], track['audio_number'],
+                                                    self.audio_formats[0], track['artist_name'],
+                                                    track['album_name'], path)
+        return self.output_paths(fullpath), filename
+
+    def episode_paths(self, episode, caller="episode"):
+        """Returns the output paths of an episode in every audio format and its filename"""
+        # Sanitize data beforehand
+        show_name = self.sanitize_data(episode['show_name'])
+        audio_name = self.sanitize_data(episode['audio_name'])
+        audio_format = self.audio_formats[0]
+
+        basepath = self.episodes_dir
+        filename = f"{show_name} - {audio_name}.{audio_format}"
+
+        if caller == "show":
+            basepath = self.episodes_dir / show_name
+            filename = f"{audio_name}.{audio_format}"
+
+        return self.output_paths(basepath / filename), filename
+
+    def output_paths(self, fullpath):
+        """Returns the path of fullpath in every audio format
+
+        With several audio formats each one gets its own tree, e.g.
+        music_dir / "ogg" / playlist / song.ogg"""
+        if len(self.audio_formats) == 1:
+            return {self.audio_formats[0]: fullpath}
+
+        root, relative = fullpath.parent, Path(fullpath.name)
+        for base in (self.music_dir, self.episodes_dir):
+            try:
+                root, relative = base, fullpath.relative_to(base)
+                break
+            except ValueError:
+                continue
+
+        return {audio_format: (root / audio_format / relative).with_suffix(f".{audio_format}")
+                for audio_format in self.audio_formats}
+
+    def download_with_progress(self, audio_id, fullpath, filename, tags=None, cover=None,
+                               audio_type=None):
+        """Downloads audio in a thread while showing its progress,
+        returns the result of download_audio"""
+        from tqdm import tqdm
+        result = {}
+
+        def download():
+            result["ok"] = self.zs_api.download_audio(audio_id, fullpath, True, tags, cover, audio_type)
+
+        downloader = Thread(target=download)
+        downloader.start()
+
+        def downloading():
+            progress = self.zs_api.progress
+            return progress and progress.get('state') == "downloading"
+
+        while not downloading() and downloader.is_alive():
+            time.sleep(0.1)
+        progress = self.zs_api.progress
+        if downloading():
+            with tqdm(
+                    desc=filename,
+                    total=progress['total'],
+                    unit="B",
+                    unit_scale=True,
+                    unit_divisor=1024,
+            ) as progress_bar:
+                while downloading():
+                    progress_bar.update(progress['downloaded'] - progress_bar.n)
+                    progress_bar.set_postfix_str("stalled" if progress['stalled'] else "", refresh=False)
+                    time.sleep(0.1)
+                progress_bar.update(progress_bar.total - progress_bar.n)
+            self.journal_state("fetched")
+            print(f"Converting {filename}")
+        downloader.join()
+        return result.get("ok", False)
+
+    # STAGING
+    def staging_paths(self, audio_id, fullpaths):
+        """Returns where to write the files of fullpaths until they are complete
+
+        Files are encoded and tagged in scratch_dir, or next to their final
+        path under a hidden name, and only then moved to fullpaths, so
+        scanners and the existing file checks never see a partial file."""
+        if self.scratch_dir is not None:
+            return {audio_format: self.scratch_dir / f"{audio_id}.{audio_format}"
+                    for audio_format in fullpaths}
+        return {audio_format: path.with_name(f".{path.stem}.part{path.suffix}")
+                for audio_format, path in fullpaths.items()}
+
+    def publish(self, staged, fullpaths):
+        """Moves the staged files to their final paths atomically"""
+        for audio_format, target in fullpaths.items():
+            source = staged[audio_format]
+            target.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.replace(source, target)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # The scratch dir is on another filesystem, copy next to the
+                # target first so the final rename is still atomic
+                part = target.with_name(f".{target.name}.part")
+                shutil.copyfile(source, part)
+                os.replace(part, target)
+                os.remove(source)
+
+    def tag_published(self, audio_id, fullpaths, **tags):
+        """Tags published files through staged copies, moved back over them
+        once tagged, so they are never seen half written"""
+        staged = self.staging_paths(audio_id, fullpaths)
+        try:
+            for audio_format, path in fullpaths.items():
+                shutil.copy2(path, staged[audio_format])
+                self.set_audio_tags(staged[audio_format], **tags)
+        except Exception:
+            self.discard(staged)
+            raise
+        self.publish(staged, fullpaths)
+
+    def discard(self, staged):
+        """Removes what is left of failed staged files"""
+        for path in staged.values():
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def run_job(self, job_id, payload, func, *args):
+        """Runs func, the download of a job, recording its state in the journal"""
+        if self.journal_job is not None or not self.journal.is_open():
+            return self.lease_job(job_id, payload, func, *args)
+
+        key = self.job_key(job_id, payload)
+        state = self.journal.state(key)
+        if state == "done":
+            print(f"Skipping {job_id} - Done before the run was interrupted")
+            return True
+        if state == "tagged" and self.finish_tagged(key):
+            return True
+        self.journal.add_job(key, job_id, payload)
+        self.journal_job = key
+        try:
+            ret = self.lease_job(job_id, payload, func, *args)
+        except Exception:
+            self.journal.set_state(key, "failed")
+            raise
+        finally:
+            self.journal_job = None
+        self.journal.set_state(key, "failed" if ret is False else "done")
+        return ret
+
+    @staticmethod
+    def job_key(job_id, payload):
+        """Returns the key of a job in the job queue and the journal, a track
+        is a different job in every folder it is downloaded to"""
+        return f"{job_id}:{payload['path'] or ''}"
+
+    def lease_job(self, job_id, payload, func, *args):
+        """Runs func only if this worker wins the lease of the job"""
+        if self.job_queue is None:
+            return func(*args)
+
+        key = self.job_key(job_id, payload)
+        if not self.job_queue.claim(key, self.worker_id, payload):
+            print(f"Skipping {job_id} - Done or claimed by another worker")
+            return True
+        try:
+            with self.job_queue.heartbeat(key, self.worker_id):
+                ret = func(*args)
+        except Exception:
+            self.job_queue.fail(key, self.worker_id)
+            raise
+        if ret is False:
+            self.job_queue.fail(key, self.worker_id)
+        elif not self.job_queue.complete(key, self.worker_id):
+            print(f"Lost lease of {key}, it is left to the worker that claimed it")
+        return ret
+
+    def drain_job_queue(self):
+        """Downloads jobs left in the queue, including the ones of crashed workers"""
+        while True:
+            job = self.job_queue.claim_next(self.worker_id)
+            if job is None:
+                if not self.job_queue.active():
+                    break
+                # Wait for the leases of other workers to finish or expire
+                time.sleep(self.job_queue.lease_time / 2)
+                continue
+            self.dispatch_job(job[1])
+        print("Job queue is empty")
+
+    def dispatch_job(self, payload):
+        """Runs a job recorded by the job queue or the journal"""
+        if payload["type"] == "upgrade":
+            return self.upgrade_entry(payload["id"])
+        if payload["type"] == "episode":
+            return self.download_episode(payload["id"], payload["caller"])
+        path = Path(payload["path"]) if payload["path"] else None
+        return self.download_track(payload["id"], path, payload["caller"])
+
+    # JOURNAL
+    def journal_state(self, state, data=None):
+        """Records the state of the job being run"""
+        if self.journal_job is not None:
+            self.journal.set_state(self.journal_job, state, data)
+
+    def journal_tagged(self, staged, fullpaths, archive):
+        """Records that the staged files are tagged, with what is needed to
+        publish and archive them without downloading them again"""
+        self.journal_state("tagged", json.loads(json.dumps(
+            {"staged": staged, "fullpaths": fullpaths, "archive": archive}, default=str)))
+
+    def finish_tagged(self, key):
+        """Publishes the staged files of a job interrupted after tagging them,
+        returns False if they are gone"""
+        data = self.journal.data.get(key)
+        if not data:
+            return False
+        staged = {audio_format: Path(path) for audio_format, path in data["staged"].items()}
+        if not all(path.exists() for path in staged.values()):
+            return False
+        self.publish(staged, {audio_format: Path(path) for audio_format, path in data["fullpaths"].items()})
+        self.archive.add(**data["archive"])
+        self.journal.set_state(key, "done")
+        print(f"Finished {data['archive']['track_name']} from the interrupted run")
+        return True
+
+    def source_finished(self, source):
+        """Returns True if the interrupted run listed a source completely, its
+        jobs are in the journal"""
+        if self.journal.is_open() and self.journal.is_source_done(source):
+            print(f"Skipping {source} - Listed before the run was interrupted")
+            return True
+        return False
+
+    def finish_source(self, source):
+        if self.journal.is_open() and self.plan is None:
+            self.journal.source_done(source)
+
+    def journal_name(self):
+        """Returns the file name of the journal of this run, one per worker"""
+        worker_id = self.args.worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        for i in self.SANITIZE_CHARS:
+            worker_id = worker_id.replace(i, "_")
+        return f"journal-{worker_id}.jsonl"
+
+    def previous_journals(self):
+        """Returns the journals of earlier runs in the config directory, only
+        the one of the worker with a --worker-id"""
+        if self.args.worker_id:
+            return RunJournal.find(self.journal.file.parent, self.journal.file.name)
+        return RunJournal.find(self.journal.file.parent)
+
+    def start_journal(self):
+        if self.plan is not None:
+            return
+        if self.args.resume and self.journal.argv is not None:
+            self.journal.resume()
+            unfinished = self.journal.unfinished()
+            print(f"Resuming the interrupted run, {len(unfinished)} downloads left")
+            for _, payload in unfinished.values():
+                self.dispatch_job(payload)
+            return
+        for journal in self.previous_journals():
+            if journal.interrupted() or journal.file == self.journal.file:
+                journal.discard()
+                print(f"Discarded the journal of an earlier run, kept as {journal.file}.prev")
+        self.journal.start(sys.argv[1:])
+
+    def retry_failed(self, attempts=3):
+        """Retries the failed downloads of the run, waiting longer after every round"""
+        import random
+        for attempt in range(attempts):
+            failed = self.journal.failed()
+            if not failed:
+                return
+            delay = min(600, 10 * 2 ** attempt) * random.uniform(0.5, 1.5)
+            print(f"Retrying {len(failed)} failed downloads in {delay:.0f}s")
+            time.sleep(delay)
+            for _, payload in failed.values():
+                self.dispatch_job(payload)
+
+    def finish_journal(self):
+        if not self.journal.is_open():
+            return
+        if self.args.resume:
+            self.retry_failed()
+        failed = self.journal.failed()
+        if failed:
+            print(f"{len(failed)} downloads failed, run with --resume to retry them")
+            self.journal.end()
+        else:
+            self.journal.finish()
+
+    # LINKS
+    def canonical_paths(self, track_id):
+        """Returns the archived files of a track in every audio format, if they
+        all exist"""
+        paths = self.archive.get_paths(track_id)
+        if not all(audio_format in paths and paths[audio_format].exists()
+                   for audio_format in self.audio_formats):
+            return None
+        return {audio_format: paths[audio_format] for audio_format in self.audio_formats}
+
+    def link_file(self, source, target, link_mode=None):
+        """Places source at target as a hardlink or reflink, falls back to a copy"""
+        link_mode = link_mode or self.link_mode
+        try:
+            if link_mode == "hardlink":
+                os.link(source, target)
+                return
+            if link_mode == "reflink":
+                import fcntl
+                FICLONE = 0x40049409
+                with open(source, "rb") as src, open(target, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+        except (OSError, ImportError) as e:
+            print(f"Unable to {link_mode} {target}, copying it: {e}")
+            if target.exists():
+                target.unlink()
+        shutil.copy2(source, target)
+
+    def place_existing(self, canonical, fullpaths):
+        """Places the already downloaded files of a track at new paths"""
+        for audio_format, target in fullpaths.items():
+            if target.exists():
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            self.link_file(canonical[audio_format], target)
+            print(f"Placed {target.name} from {canonical[audio_format]}")
+
+    def place_again(self, track_id):
+        """Places again the files placed from an entry whose files were
+        replaced, hardlinks would keep the old files otherwise"""
+        paths = self.archive.get_paths(track_id)
+        for link_mode, fullpaths in self.archive.get_placements(track_id):
+            for audio_format, target in fullpaths.items():
+                source = paths.get(audio_format)
+                # Placed files removed since then are not brought back
+                if source is None or not target.exists() or os.path.samefile(source, target):
+                    continue
+                part = target.with_name(f".{target.name}.part")
+                self.link_file(source, part, link_mode)
+                os.replace(part, target)
+                print(f"Placed {target.name} again from {source}")
+
+    def write_m3u8(self, name, track_ids):
+        """Writes a playlist file in music_dir pointing at the archived files"""
+        for audio_format in self.audio_formats:
+            base = self.output_paths(self.music_dir / "playlist")[audio_format].parent
+            m3u8_path = base / f"{self.sanitize_data(name)}.m3u8"
+            lines = ["#EXTM3U"]
+            for track_id in track_ids:
+                path = self.archive.get_paths(track_id).get(audio_format)
+                if path is not None:
+                    lines.append(os.path.relpath(path, base))
+            base.mkdir(parents=True, exist_ok=True)
+            with open(m3u8_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            print(f"Saved playlist {m3u8_path}")
+
+    def find_equivalent(self, track):
+        """Returns the id and files of an archived recording with the same
+        ISRC as track, None if there is none"""
+        if not track['isrc']:
+            return None
+        for equivalent in self.archive.find_isrc(track['isrc']):
+            existing = self.canonical_paths(equivalent)
+            if equivalent != track['id'] and existing is not None:
+                return equivalent, existing
+        return None
+
+    def reuse_equivalent(self, track, fullpaths, filename):
+        """Places an archived recording with the same ISRC instead of downloading
+        the track again, returns True if one was found
+
+        The placed files are tagged with the album, numbers and cover of this
+        track, except hardlinks, which share the tags of the other release."""
+        found = self.find_equivalent(track)
+        if found is None:
+            return False
+        equivalent, existing = found
+        print(f"Skipping {filename} - Same recording as {equivalent} ({track['isrc']})")
+        if self.link_mode != "m3u8" and existing != fullpaths:
+            self.lookup_genres(track)
+            tags = self.track_tags(track)
+            # Placed and tagged while staged, like downloads
+            targets = {audio_format: path for audio_format, path in fullpaths.items()
+                       if path != existing[audio_format]}
+            staged = self.staging_paths(track['id'], targets)
+            self.discard(staged)
+            linked = {}
+            try:
+                for audio_format, path in staged.items():
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    self.link_file(existing[audio_format], path)
+                    if os.path.samefile(existing[audio_format], path):
+                        linked[audio_format] = targets[audio_format]
+                    else:
+                        self.set_audio_tags(path, image_url=track['image_url'], **tags)
+            except Exception:
+                self.discard(staged)
+                raise
+            self.publish(staged, targets)
+            print(f"Placed {filename} from {equivalent}")
+            if linked:
+                self.archive.add_placement(equivalent, "hardlink", linked)
+            existing = fullpaths
+        first_format = self.audio_formats[0]
+        self.archive.add(track['id'],
+                         artist=track['artist_name'],
+                         track_name=track['audio_name'],
+                         fullpath=existing[first_format],
+                         audio_type="music",
+                         fullpaths=existing if len(existing) > 1 else None,
+                         isrc=track['isrc'])
+        return True
+
+    # UPGRADE
+    def archive_quality(self):
+        """Returns the quality and bitrate (kbps) to archive new downloads with"""
+        return {"quality": self.zs_api.quality.name,
+                "bitrate": int(self.zs_api.get_bitrate().rstrip("k"))}
+
+    def archived_bitrate(self, track_id):
+        """Returns the bitrate (kbps) of an archived entry, entries archived
+        before bitrates were recorded are probed from their files"""
+        entry = self.archive.get(track_id)
+        if entry.get("bitrate"):
+            return entry["bitrate"]
+        import mutagen
+        bitrates = []
+        for path in self.archive.get_paths(track_id).values():
+            try:
+                audio = mutagen.File(path)
+            except Exception as e:
+                print(f"Unable to read the bitrate of {path}: {e}")
+                continue
+            if audio is not None and getattr(audio.info, "bitrate", 0):
+                bitrates.append(audio.info.bitrate // 1000)
+        return min(bitrates) if bitrates else None
+
+    def upgrade(self):
+        """Downloads again, in place, the archived files encoded below the
+        bitrate of the current account"""
+        bitrate = int(self.zs_api.get_bitrate().rstrip("k"))
+        outdated = []
+        probed = False
+        for track_id, entry in list(self.archive.get_all().items()):
+            paths = self.archive.get_paths(track_id)
+            if not paths or not all(path.exists() for path in paths.values()):
+                continue
+            archived = self.archived_bitrate(track_id)
+            if archived is None:
+                continue
+            if not entry.get("bitrate"):
+                # Remembered so the files are not probed again
+                entry.bitrate = archived
+                probed = True
+            # Encoders do not hit the nominal bitrate exactly
+            if archived < bitrate * 0.9:
+                outdated.append(track_id)
+        if probed:
+            self.archive.save()
+
+        print(f"Found {len(outdated)} downloads below {bitrate}k")
+        if self.plan is not None:
+            return True
+        # Entries reusing the files of another one, or files placed from them,
+        # are upgraded with that one instead of downloading the same files twice
+        owners = {}
+        for track_id in outdated:
+            for _, fullpaths in self.archive.get_placements(track_id):
+                for path in fullpaths.values():
+                    owners.setdefault(path, track_id)
+        upgraded = set()
+        shared = []
+        for track_id in outdated:
+            paths = self.archive.get_paths(track_id).values()
+            covering = {owners.get(path) for path in paths}
+            if None not in covering:
+                shared.append((track_id, covering))
+                continue
+            for path in paths:
+                owners.setdefault(path, track_id)
+            if self.upgrade_entry(track_id) is not False:
+                upgraded.add(track_id)
+                self.place_again(track_id)
+        for track_id, covering in shared:
+            if covering <= upgraded:
+                entry = self.archive.get(track_id)
+                upgrade = self.archive.get(next(iter(covering)))
+                entry.quality, entry.bitrate = upgrade.quality, upgrade.bitrate
+                print(f"Upgraded {entry.track_name} with the files of {', '.join(covering)}")
+        if shared:
+            self.archive.save()
+        print("Finished upgrading")
+        return True
+
+    def upgrade_entry(self, track_id):
+        """Downloads an archived track or episode again over its files"""
+        paths = self.archive.get_paths(track_id)
+        payload = {"type": "upgrade", "id": track_id, "path": None, "caller": "upgrade"}
+        # Upgrades are separate jobs, the first download is already done
+        job_id = f"upgrade:{track_id}"
+        if self.archive.get(track_id).get("audio_type") == "episode":
+            return self.run_job(job_id, payload, self._download_episode, track_id, "upgrade", paths)
+        return self.run_job(job_id, payload, self._download_track, track_id, None, "upgrade", paths)
+
+    # WATCH
+    def load_watch_sources(self, watch_file):
+        """Reads the sources of --watch, a json file like
+        {"interval": 3600, "jitter": 0.1,
+         "sources": [{"url": "https://open.spotify.com/show/...", "interval": 1800},
+                     {"url": "spotify:playlist:..."}]}"""
+        with open(watch_file, "r") as f:
+            config = json.load(f)
+        sources = []
+        for source in config["sources"]:
+            parsed_url = self.zs_api.parse_url(source["url"])
+            if parsed_url['show']:
+                kind, source_id = "show", parsed_url['show']
+            elif parsed_url['playlist']:
+                kind, source_id = "playlist", parsed_url['playlist']
+            else:
+                print(f"Ignoring {source['url']} - Only shows and playlists can be watched")
+                continue
+            sources.append({"kind": kind,
+                            "id": source_id,
+                            "interval": source.get("interval", config.get("interval", self.args.watch_interval)),
+                            "jitter": source.get("jitter", config.get("jitter", 0.1))})
+        return sources
+
+    def poll_show(self, show_id, watched):
+        """Downloads the episodes published since the last poll and retries
+        the ones that failed, watched["seen"] is the list of known episode
+        ids, newest first, and watched["failed"] the ones to retry"""
+        seen = watched.get("seen", [])
+        known = set(seen)
+        new = []
+        # Episodes are listed newest first, stop paging at the first known one
+        for episode in self.zs_api.iter_show_episodes(show_id):
+            if episode['id'] in known or self.archive.exists(episode['id']):
+                break
+            new.append(episode['id'])
+        # Newer episodes move the boundary past a failed one, so failures
+        # are kept apart and retried by every poll
+        retry = [episode_id for episode_id in watched.get("failed", []) if episode_id not in new]
+        watched["failed"] = [episode_id for episode_id in retry + new[::-1]
+                             if self.download_episode(episode_id, "show") is False]
+        # The newest episodes are enough to find where to stop
+        watched["seen"] = (new + seen)[:500]
+        return len(new)
+
+    def poll_playlist(self, playlist_id, watched):
+        """Downloads the tracks added since the last poll"""
+        playlist = self.zs_api.get_playlist_info(playlist_id)
+        # Tracks can be added anywhere in a playlist, but an unchanged
+        # snapshot means there is nothing to list
+        if playlist['snapshot_id'] == watched.get("snapshot_id"):
+            return 0
+        seen = set(watched.get("seen", []))
+        basepath = self.music_dir / self.sanitize_data(playlist['name'])
+        new = 0
+        complete = True
+        for song in self.zs_api.iter_playlist_songs(playlist_id):
+            if song['id'] in seen or self.archive.exists(song['id']):
+                seen.add(song['id'])
+                continue
+            new += 1
+            if self.download_track(song['id'], basepath, "playlist") is False:
+                complete = False
+            else:
+                seen.add(song['id'])
+        watched["seen"] = list(seen)
+        if complete:
+            watched["snapshot_id"] = playlist['snapshot_id']
+        return new
+
+    def watch(self, watch_file):
+        """Polls shows and playlists forever, downloading what is new"""
+        import heapq
+        import random
+
+        sources = self.load_watch_sources(watch_file)
+        if not sources:
+            print("Nothing to watch")
+            return False
+        watching = self.state.get("watch", {})
+        queue = [(time.time(), i) for i in range(len(sources))]
+        heapq.heapify(queue)
+        print(f"Watching {len(sources)} shows and playlists, press CTRL-C to stop")
+        while True:
+            due, i = heapq.heappop(queue)
+            if due > time.time():
+                time.sleep(due - time.time())
+            source = sources[i]
+            key = f"{source['kind']}:{source['id']}"
+            watched = watching.setdefault(key, {})
+            try:
+                if source['kind'] == "show":
+                    new = self.poll_show(source['id'], watched)
+                else:
+                    new = self.poll_playlist(source['id'], watched)
+                print(f"Polled {key}: {new} new")
+            except Exception as e:
+                print(f"Failed polling {key}: {e}")
+            self.state.set("watch", watching)
+            interval = source['interval'] * (1 + random.uniform(-source['jitter'], source['jitter']))
+            heapq.heappush(queue, (time.time() + interval, i))
+
+    # PLAN
+    def make_plan(self, jobs):
+        """Resolves the metadata of planned jobs and diffs them against the
+        archive and the disk"""
+        track_ids = list({job['id'] for job in jobs if job['type'] == "track"})
+        episode_ids = list({job['id'] for job in jobs if job['type'] == "episode"})
+        infos = {**self.zs_api.get_audio_infos(track_ids),
+                 **self.zs_api.get_episode_infos(episode_ids)}
+        bitrate = int(self.zs_api.get_bitrate().rstrip("k")) * 1000
+
+        # Jobs are keyed by their first output path, the same track can be
+        # placed in several playlists
+        all_jobs, unplayable, archived, on_disk, linked = set(), set(), set(), set(), set()
+        planned = {}
+        for job in jobs:
+            info = infos.get(job['id'])
+            if info is None or not info['is_playable']:
+                key = f"{job['type']}:{job['id']}:{job['path']}"
+                unplayable.add(key)
+                fullpaths = {}
+            else:
+                if job['type'] == "episode":
+                    fullpaths, _ = self.episode_paths(info, job['caller'])
+                else:
+                    path = Path(job['path']) if job['path'] else None
+                    fullpaths, _ = self.track_paths(info, path, job['caller'])
+                key = str(fullpaths[self.audio_formats[0]])
+                canonical = self.canonical_paths(job['id']) \
+                    if self.link_mode and job['type'] == "track" else None
+                if canonical and canonical != fullpaths:
+                    # Archived in another folder, it is placed from there
+                    linked.add(key)
+                elif all(p.exists() for p in fullpaths.values()):
+                    on_disk.add(key)
+                elif info.get('isrc') and any(self.canonical_paths(equivalent)
+                                              for equivalent in self.archive.find_isrc(info['isrc'])):
+                    # Same recording as an archived track, it is reused
+                    linked.add(key)
+            if self.archive.exists(job['id']):
+                archived.add(key)
+            all_jobs.add(key)
+            planned[key] = {**job,
+                            "fullpaths": {f: str(p) for f, p in fullpaths.items()},
+                            "bytes": info['duration_ms'] * bitrate // 8000 if info else 0}
+
+        present = set()
+        # With a link mode archived tracks are still placed in their new folder
+        if self.skip_downloaded and not self.link_mode:
+            present |= archived
+        if self.not_skip_existing:
+            present |= on_disk
+        present -= unplayable
+        linked -= unplayable | present
+        to_fetch = all_jobs - unplayable - present - linked
+
+        for key, job in planned.items():
+            job['status'] = "fetch" if key in to_fetch else \
+                "unplayable" if key in unplayable else \
+                "link" if key in linked else "present"
+        total_bytes = sum(planned[key]['bytes'] for key in to_fetch)
+        eta = total_bytes / self.args.plan_rate + len(to_fetch) * self.args.antiban_time
+        return {"created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "summary": {"fetch": len(to_fetch),
+                            "link": len(linked),
+                            "present": len(present),
+                            "unplayable": len(unplayable),
+                            "bytes": total_bytes,
+                            "eta_seconds": int(eta)},
+                "jobs": list(planned.values())}
+
+    def print_plan(self, plan):
+        summary = plan['summary']
+        print(f"\n{Style.GREEN}PLAN{Style.RESET}")
+        print(f"Tracks to fetch:  {summary['fetch']}")
+        print(f"To link or reuse: {summary.get('link', 0)}")
+        print(f"Already present:  {summary['present']}")
+        print(f"Unplayable:       {summary['unplayable']}")
+        print(f"Estimated size:   {summary['bytes'] / 1024 / 1024:.1f} MiB")
+        print(f"Estimated time:   {datetime.timedelta(seconds=summary['eta_seconds'])}")
+
+    def execute_plan(self, plan_file):
+        """Downloads the jobs of a plan saved with --plan-file"""
+        with open(plan_file, "r") as f:
+            plan = json.load(f)
+        # Linked tracks are placed from the archived files
+        jobs = [job for job in plan['jobs'] if job['status'] in ("fetch", "link")]
+        print(f"Executing plan of {len(jobs)} tracks from {plan['created']}")
+        for job in jobs:
+            if job['type'] == "episode":
+                self.download_episode(job['id'], job['caller'])
+            else:
+                path = Path(job['path']) if job['path'] else None
+                self.download_track(job['id'], path, job['caller'])
+        print("Finished executing plan")
+
+    def lookahead(self, items, caller, path=None, audio_type="track", batch=50):
+        """Yields the tracks or episodes of a listing, resolving them a batch
+        ahead of their download
+
+        The metadata of a batch is fetched at once. For the items that will
+        be downloaded, the genres of their artists are looked up together
+        and the streams of the next --prefetch are opened in the background.
+        path is the folder of the items, or a function of an item returning
+        it."""
+        if self.plan is not None:
+            yield from items
+            return
+        items = iter(items)
+        window = collections.deque()
+        downloads = set()
+        listing = True
+        try:
+            while True:
+                if listing and len(window) <= self.args.prefetch:
+                    resolved = list(itertools.islice(items, batch))
+                    listing = len(resolved) == batch
+                    window.extend(resolved)
+                    downloads.update(self.resolve_downloads(resolved, caller, path, audio_type))
+                if not window:
+                    return
+                current = window.popleft()
+                if self.args.prefetch:
+                    self.zs_api.prefetch_streams([item['id'] for item in window
+                                                  if item['id'] in downloads][:self.args.prefetch],
+                                                 audio_type)
+                yield current
+        finally:
+            for item in window:
+                self.resolved_infos.pop(item['id'], None)
+            if self.args.prefetch:
+                self.zs_api.discard_streams([item['id'] for item in window])
+
+    def resolve_downloads(self, items, caller, path=None, audio_type="track"):
+        """Fetches the metadata of listed items and returns the ids of the
+        ones that will be downloaded
+
+        Items done in the journal, claimed by another worker or archived are
+        left out before any request, the others after the same checks as
+        _download_track and _download_episode. The metadata is kept in
+        resolved_infos for the download."""
+        candidates = []
+        for item in items:
+            item_path = path(item) if callable(path) else path
+            key = self.job_key(item['id'], {"path": str(item_path) if item_path else None})
+            if self.journal.is_open() and self.journal.state(key) == "done":
+                continue
+            if self.job_queue is not None and not self.job_queue.claimable(key, self.worker_id):
+                continue
+            if self.archive.exists(item['id']) and (
+                    self.canonical_paths(item['id']) if self.link_mode else self.args.skip_downloaded):
+                continue
+            candidates.append((item['id'], item_path))
+        if not candidates:
+            return set()
+
+        ids = list(dict.fromkeys(audio_id for audio_id, _ in candidates))
+        try:
+            if audio_type == "episode":
+                infos = self.zs_api.get_episode_infos(ids)
+            else:
+                infos = self.zs_api.get_audio_infos(ids)
+        except Exception as e:
+            # Every download fetches its own metadata instead
+            print(f"Unable to resolve {len(ids)} upcoming downloads: {e}")
+            return set()
+        self.resolved_infos.update((audio_id, info) for audio_id, info in infos.items() if info)
+
+        downloads = set()
+        for audio_id, item_path in candidates:
+            info = infos.get(audio_id)
+            if info is None or not info['is_playable']:
+                continue
+            if audio_type == "episode":
+                fullpaths, _ = self.episode_paths(info, caller)
+            else:
+                fullpaths, _ = self.track_paths(info, item_path, caller)
+            if self.not_skip_existing and all(p.exists() for p in fullpaths.values()):
+                continue
+            if audio_type == "track" and self.find_equivalent(info) is not None:
+                continue
+            downloads.add(audio_id)
+        if self.genres and audio_type == "track":
+            try:
+                self.zs_api.get_artist_genres([artist_id for audio_id in downloads
+                                               for artist_id in infos[audio_id]['artist_ids']])
+            except Exception as e:
+                # Looked up again by every download
+                print(f"Unable to look up the genres of {len(downloads)} upcoming downloads: {e}")
+        return downloads
+
+    def lookup_genres(self, track):
+        """Sets the genres of a track from its artists, the genre tag is left
+        out if they cannot be looked up"""
+        if not self.genres:
+            return
+        try:
+            track['genres'] = self.zs_api.genres_of(track['artist_ids'])
+        except Exception as e:
+            print(f"Unable to look up the genres of {track['audio_name']}: {e}")
+
     def download_track(self, track_id, path=None, caller=None):
-        if self.args.skip_downloaded and self.archive.exists(track_id):
+        payload = {"type": "track",
+                   "id": track_id,
+                   "path": str(path) if path else None,
+                   "caller": caller}
+        if self.plan is not None:
+            self.plan.append(payload)
+            return True
+        return self.run_job(track_id, payload, self._download_track, track_id, path, caller)
+
+    @traced("download_track")
+    def _download_track(self, track_id, path=None, caller=None, replace=None):
+        """Downloads a track, replace is a dict of audio format to archived
+        files to overwrite instead (see upgrade)"""
+        # With a link mode archived tracks are still placed in their new folder
+        if replace is None and self.args.skip_downloaded and self.archive.exists(track_id) \
+                and not self.link_mode:
             print(f"Skipping {track_id} - Already Downloaded")
             return True
 
-        track = self.zs_api.get_audio_info(track_id)
+        track = self.resolved_infos.pop(track_id, None) or self.zs_api.get_audio_info(track_id)
 
         if track is None:
             print(f"Skipping {track_id} - Could not get track info")
@@ -511,80 +1791,99 @@ class ZSpotify:
             return True
 
         audio_name = track['audio_name']
-        audio_format = self.args.audio_format
-        audio_number = track['audio_number']
+        audio_format = self.audio_formats[0]
         artist_name = track['artist_name']
-        album_name = track['album_name']
 
-        # Sanitize and set full path once
-        fullpath, filename = self.generate_filename(caller, audio_name, audio_number, audio_format, artist_name,
-                                                    album_name, path)
+        if replace is not None:
+            fullpaths, filename = replace, next(iter(replace.values())).name
+            fullpath = fullpaths.get(audio_format, next(iter(replace.values())))
+        else:
+            fullpaths, filename = self.track_paths(track, path, caller)
+            fullpath = fullpaths[audio_format]
 
-        if self.not_skip_existing and fullpath.exists():
-            print(f"Skipping {filename} - Already downloaded")
-            return True
-        downloader = \
-            Thread(target=self.zs_api.download_audio,
-                   args=(track_id, fullpath, True))
-        downloader.start()
+            canonical = self.canonical_paths(track_id)
+            if self.link_mode and canonical and canonical != fullpaths:
+                if self.link_mode == "m3u8":
+                    print(f"Skipping {filename} - Already downloaded to {canonical[audio_format]}")
+                else:
+                    self.place_existing(canonical, fullpaths)
+                    self.archive.add_placement(track_id, self.link_mode, fullpaths)
+                return True
 
-        while not self.zs_api.progress:
-            time.sleep(0.1)
-        with tqdm(
-                desc=filename,
-                total=self.zs_api.progress['total'],
-                unit="B",
-                unit_scale=True,
-                unit_divisor=1024,
-        ) as progress_bar:
-            progress = self.zs_api.progress
-            while progress:
-                progress_bar.update(progress['downloaded'] - progress_bar.n)
-                time.sleep(0.1)
-                progress = self.zs_api.progress
-            progress_bar.update(progress_bar.total - progress_bar.n)
-        print(f"Converting {filename}")
-        self.archive.add(track_id,
-                         artist=artist_name,
-                         track_name=audio_name,
-                         fullpath=fullpath,
-                         audio_type="music")
-        downloader.join()
+            if self.not_skip_existing and all(p.exists() for p in fullpaths.values()):
+                print(f"Skipping {filename} - Already downloaded")
+                return True
+
+            if self.reuse_equivalent(track, fullpaths, filename):
+                return True
+
+        # Only looked up for tracks that are downloaded
+        self.lookup_genres(track)
+
+        tags = self.track_tags(track)
+        encode_tags, cover = None, None
+        if not self.tag_in_place:
+            encode_tags, cover = self.encode_tags(**tags), self.get_cover(track['image_url'])
+
+        staged = self.staging_paths(track_id, fullpaths)
+        if not self.download_with_progress(track_id, staged, filename, encode_tags, cover, "track"):
+            self.discard(staged)
+            print(f"Failed downloading {filename}")
+            return False
+        self.journal_state("converted")
+        replaygain = None
+        loudness = self.zs_api.loudness.pop(track_id, None)
+        if loudness is not None:
+            replaygain = self.zs_api.replaygain_tags([loudness])
+            if self.album_loudness is not None:
+                self.album_loudness.append((loudness, track_id, fullpaths))
         print(f"Set audiotags {filename}")
-        self.set_audio_tags(fullpath,
-                            artists=artist_name,
-                            name=audio_name,
-                            album_name=album_name,
-                            release_year=track['release_year'],
-                            disc_number=track['disc_number'],
-                            track_number=audio_number,
-                            track_id_str=track['scraped_song_id'],
-                            image_url=track['image_url'])
+        self.tag_outputs(staged, tags, track['image_url'], cover, replaygain)
+        archive = {"track_id": track_id,
+                   "artist": artist_name,
+                   "track_name": audio_name,
+                   "fullpath": fullpath,
+                   "audio_type": "music",
+                   "fullpaths": fullpaths if len(fullpaths) > 1 else None,
+                   "isrc": track['isrc'],
+                   **self.archive_quality()}
+        self.journal_tagged(staged, fullpaths, archive)
+        self.publish(staged, fullpaths)
+        self.archive.add(**archive)
         print(f"Finished downloading {filename}")
+        return True
 
     def download_playlist(self, playlist_id):
+        if self.source_finished(f"playlist:{playlist_id}"):
+            return True
         playlist = self.zs_api.get_playlist_info(playlist_id)
         if not playlist:
             print("Playlist not found")
             return False
-        songs = self.zs_api.get_playlist_songs(playlist_id)
-        if not songs:
-            print("Playlist is empty")
-            return False
         print(f"Downloading {playlist['name']} playlist")
         basepath = self.music_dir / self.sanitize_data(playlist['name'])
-        for song in songs:
+        # Songs are downloaded as the pages of the playlist arrive
+        track_ids = []
+        for song in self.lookahead(self.zs_api.iter_playlist_songs(playlist_id), "playlist", basepath):
+            track_ids.append(song['id'])
             self.download_track(song['id'], basepath, "playlist")
+        if not track_ids:
+            print("Playlist is empty")
+            return False
+        if self.link_mode == "m3u8" and self.plan is None:
+            self.write_m3u8(playlist['name'], track_ids)
+        self.finish_source(f"playlist:{playlist_id}")
         print(f"Finished downloading {playlist['name']} playlist")
 
     def download_all_user_playlists(self):
-        playlists = self.zs_api.get_all_user_playlists()
-        if not playlists:
-            print("No playlists found")
-            return False
-        for playlist in playlists['playlists']:
+        found = False
+        for playlist in self.zs_api.iter_all_user_playlists():
+            found = True
             self.download_playlist(playlist['id'])
             self.antiban_wait(self.antiban_album_time)
+        if not found:
+            print("No playlists found")
+            return False
         print("Finished downloading all user playlists")
 
     def download_select_user_playlists(self):
@@ -631,6 +1930,8 @@ class ZSpotify:
         print("Finished downloading selected playlists")
 
     def download_album(self, album_id):
+        if self.source_finished(f"album:{album_id}"):
+            return True
         album = self.zs_api.get_album_info(album_id)
         if not album:
             print("Album not found")
@@ -653,20 +1954,31 @@ class ZSpotify:
         # Concat download path
         basepath = self.music_dir / artists / album_name
 
-        for song in songs:
+        def disc_path(song):
             # Append disc number to filepath if more than 1 disc
-            newBasePath = basepath
             if disc_number_flag:
-                disc_number = self.sanitize_data(f"{self.zfill(song['disc_number'])}")
-                newBasePath = basepath / disc_number
+                return basepath / self.sanitize_data(f"{self.zfill(song['disc_number'])}")
+            return basepath
+
+        self.album_loudness = []
+        for song in self.lookahead(songs, "album", disc_path):
+            self.download_track(song['id'], disc_path(song), "album")
 
-            self.download_track(song['id'], newBasePath, "album")
+        album_loudness, self.album_loudness = self.album_loudness, None
+        replaygain = self.zs_api.replaygain_tags([loudness for loudness, _, _ in album_loudness], "ALBUM")
+        if replaygain:
+            print(f"Set album gain {album_name}")
+            for _, track_id, fullpaths in album_loudness:
+                self.tag_published(track_id, fullpaths, replaygain=replaygain)
 
+        self.finish_source(f"album:{album_id}")
         print(
             f"Finished downloading {album['artists']} - {album['name']} album")
         return True
 
     def download_artist(self, artist_id):
+        if self.source_finished(f"artist:{artist_id}"):
+            return True
         artist = self.zs_api.get_artist_info(artist_id)
         if not artist:
             print("Artist not found")
@@ -678,18 +1990,50 @@ class ZSpotify:
         for album in albums:
             self.download_album(album['id'])
             self.antiban_wait(self.antiban_album_time)
+        self.finish_source(f"artist:{artist_id}")
         print(f"Finished downloading {artist['name']} artist")
         return True
 
     def download_liked_songs(self):
-        songs = self.zs_api.get_liked_tracks()
-        if not songs:
+        if self.source_finished("liked_songs"):
+            return True
+        # Liked songs are listed newest first, an incremental sync stops at the
+        # first song already archived or liked before the last sync
+        watermark = self.state.get("liked_songs_added_at") if self.args.incremental else None
+        newest = None
+        complete = True
+        songs = []
+        basepath = self.music_dir / "Liked Songs"
+
+        def unsynced(liked):
+            # Stops the listing before lookahead resolves songs already synced
+            nonlocal newest
+            for song in liked:
+                if newest is None:
+                    newest = song['added_at']
+                    print("Downloading liked songs")
+                if self.args.incremental and (self.archive.exists(song['id']) or
+                                              (watermark and song['added_at'] <= watermark)):
+                    print("Reached liked songs already synced")
+                    return
+                yield song
+
+        for song in self.lookahead(unsynced(self.zs_api.iter_liked_tracks()), "liked_songs", basepath):
+            songs.append(song)
+            if self.download_track(song['id'], basepath, "liked_songs") is False:
+                complete = False
+        if newest is None:
             print("No liked songs found")
             return False
-        print("Downloading liked songs")
-        basepath = self.music_dir / "Liked Songs"
-        for song in songs:
-            self.download_track(song['id'], basepath, "liked_songs")
+        if self.link_mode == "m3u8" and self.plan is None:
+            if self.args.incremental:
+                print("Not updating Liked Songs.m3u8 in incremental mode")
+            else:
+                self.write_m3u8("Liked Songs", [song['id'] for song in songs])
+        # Failed songs are retried next time
+        if complete and self.plan is None:
+            self.state.set("liked_songs_added_at", max(newest, watermark or newest))
+        self.finish_source("liked_songs")
         print("Finished downloading liked songs")
         return True
 
@@ -713,11 +2057,21 @@ class ZSpotify:
         return ret
 
     def download_episode(self, episode_id, caller="episode"):
-        if self.args.skip_downloaded and self.archive.exists(episode_id):
+        payload = {"type": "episode", "id": episode_id, "path": None, "caller": caller}
+        if self.plan is not None:
+            self.plan.append(payload)
+            return True
+        return self.run_job(episode_id, payload, self._download_episode, episode_id, caller)
+
+    @traced("download_episode")
+    def _download_episode(self, episode_id, caller="episode", replace=None):
+        """Downloads an episode, replace is a dict of audio format to archived
+        files to overwrite instead (see upgrade)"""
+        if replace is None and self.args.skip_downloaded and self.archive.exists(episode_id):
             print(f"Skipping {episode_id} - Already Downloaded")
             return True
 
-        episode = self.zs_api.get_episode_info(episode_id)
+        episode = self.resolved_infos.pop(episode_id, None) or self.zs_api.get_episode_info(episode_id)
         if not episode:
             print("Episode not found")
             return False
@@ -727,62 +2081,53 @@ class ZSpotify:
             print(f"Skipping {episode['audio_name']} - Not Available")
             return True
 
-        # Sanitize data beforehand
-        show_name = self.sanitize_data(episode['show_name'])
-        audio_name = self.sanitize_data(episode['audio_name'])
-        audio_format = self.args.audio_format
-
-        basepath = self.episodes_dir
-        filename = f"{show_name} - {audio_name}.{audio_format}"
-
-        if caller == "show":
-            basepath = self.episodes_dir / show_name
-            filename = f"{audio_name}.{audio_format}"
-
-        fullpath = basepath / filename
+        if replace is not None:
+            fullpaths, filename = replace, next(iter(replace.values())).name
+            fullpath = fullpaths.get(self.audio_formats[0], next(iter(replace.values())))
+        else:
+            fullpaths, filename = self.episode_paths(episode, caller)
+            fullpath = fullpaths[self.audio_formats[0]]
 
-        if self.not_skip_existing and fullpath.exists():
+        if replace is None and self.not_skip_existing and all(p.exists() for p in fullpaths.values()):
             print(f"Skipping {filename} - Already downloaded")
             return True
 
-        # self.zs_api.download_audio(episode_id, fullpath, True)
-        downloader = \
-            Thread(target=self.zs_api.download_audio,
-                   args=(episode_id, fullpath, True))
-        downloader.start()
-
-        while not self.zs_api.progress:
-            time.sleep(0.1)
-        with tqdm(
-                desc=filename,
-                total=self.zs_api.progress['total'],
-                unit="B",
-                unit_scale=True,
-                unit_divisor=1024,
-        ) as progress_bar:
-            progress = self.zs_api.progress
-            while progress:
-                progress_bar.update(progress['downloaded'] - progress_bar.n)
-                time.sleep(0.1)
-                progress = self.zs_api.progress
-            progress_bar.update(progress_bar.total - progress_bar.n)
-        print(f"Converting {episode['audio_name']} episode")
-        downloader.join()
-        self.archive.add(episode_id,
-                         artist=episode['show_name'],
-                         track_name=episode['audio_name'],
-                         fullpath=fullpath,
-                         audio_type="episode")
+        tags = {"artists": episode['show_name'],
+                "name": episode['audio_name'],
+                "release_year": episode['release_year'],
+                "track_id_str": episode_id}
+        encode_tags, cover = None, None
+        if not self.tag_in_place:
+            encode_tags, cover = self.encode_tags(**tags), self.get_cover(episode['image_url'])
+
+        staged = self.staging_paths(episode_id, fullpaths)
+        if not self.download_with_progress(episode_id, staged, filename, encode_tags, cover, "episode"):
+            self.discard(staged)
+            print(f"Failed downloading {episode['audio_name']} episode")
+            return False
+        self.journal_state("converted")
+        replaygain = None
+        loudness = self.zs_api.loudness.pop(episode_id, None)
+        if loudness is not None:
+            replaygain = self.zs_api.replaygain_tags([loudness])
         print(f"Set audiotags {episode['audio_name']}")
-        self.set_audio_tags(fullpath,
-                            artists=episode['show_name'],
-                            name=episode['audio_name'],
-                            release_year=episode['release_year'],
-                            track_id_str=episode_id,
-                            image_url=episode['image_url'])
+        self.tag_outputs(staged, tags, episode['image_url'], cover, replaygain)
+        archive = {"track_id": episode_id,
+                   "artist": episode['show_name'],
+                   "track_name": episode['audio_name'],
+                   "fullpath": fullpath,
+                   "audio_type": "episode",
+                   "fullpaths": fullpaths if len(fullpaths) > 1 else None,
+                   **self.archive_quality()}
+        self.journal_tagged(staged, fullpaths, archive)
+        self.publish(staged, fullpaths)
+        self.archive.add(**archive)
         print(f"Finished downloading {episode['audio_name']} episode")
+        return True
 
     def download_all_show_episodes(self, show_id):
+        if self.source_finished(f"show:{show_id}"):
+            return True
         show = self.zs_api.get_show_info(show_id)
         if not show:
             print("Show not found")
@@ -791,78 +2136,98 @@ class ZSpotify:
         if not episodes:
             print("Show has no episodes")
             return False
-        for episode in episodes:
+        for episode in self.lookahead(episodes, "show", audio_type="episode"):
             self.download_episode(episode['id'], "show")
+        self.finish_source(f"show:{show_id}")
         print(f"Finished downloading {show['name']} show")
         return True
 
+    def download_result(self, result):
+        """Downloads a search result"""
+        if result['type'] == 'track':
+            self.download_track(result['id'])
+        elif result['type'] == 'album':
+            self.download_album(result['id'])
+        elif result['type'] == 'playlist':
+            self.download_playlist(result['id'])
+        elif result['type'] == 'artist':
+            self.download_artist(result['id'])
+        elif result['type'] == 'show':
+            self.download_all_show_episodes(result['id'])
+        elif result['type'] == 'episode':
+            self.download_episode(result['id'])
+
     def search(self, query):
         # TODO: Add search by artist, album, playlist, etc.
-        results = self.zs_api.search(query)
-        if not results:
-            print("No results found")
-            return False
-        print("Search results:")
-        print(f"{Style.GREEN}TRACKS{Style.RESET}")
-        full_results = []
-        i = 1
-        for result in results['tracks']:
-            print(f"{i}. {result['artists']} - {result['name']}")
-            result['type'] = 'track'
-            full_results.append(result)
-            i += 1
-        print(f"\n{Style.GREEN}ALBUMS{Style.RESET}")
-        for result in results['albums']:
-            print(f"{i}. {result['artists']} - {result['name']}")
-            result['type'] = 'album'
-            full_results.append(result)
-            i += 1
-        print(f"\n{Style.GREEN}PLAYLISTS{Style.RESET}")
-        for result in results['playlists']:
-            print(f"{i}. {result['name']}")
-            result['type'] = 'playlist'
-            full_results.append(result)
-            i += 1
-        print(f"\n{Style.GREEN}ARTISTS{Style.RESET}")
-        for result in results['artists']:
-            print(f"{i}. {result['name']}")
-            result['type'] = 'artist'
-            full_results.append(result)
-            i += 1
-        print("")
-        print("Enter the number of the item you want to download")
-        print(f"allowed delimiters: {self.SEPARATORS}")
-        print("Enter 'all' to download all items")
-        print("Enter 'exit' to exit")
-        selection = input(">>>")
-        while selection == "":
+        offset = 0
+        while True:
+            results = self.zs_api.search(query, offset)
+            if not results:
+                print("No results found" if offset == 0 else "No more results")
+                return False
+            print("Search results:")
+            print(f"{Style.GREEN}TRACKS{Style.RESET}")
+            full_results = []
+            i = 1
+            for result in results['tracks']:
+                print(f"{i}. {result['artists']} - {result['name']}")
+                result['type'] = 'track'
+                full_results.append(result)
+                i += 1
+            print(f"\n{Style.GREEN}ALBUMS{Style.RESET}")
+            for result in results['albums']:
+                print(f"{i}. {result['artists']} - {result['name']}")
+                result['type'] = 'album'
+                full_results.append(result)
+                i += 1
+            print(f"\n{Style.GREEN}PLAYLISTS{Style.RESET}")
+            for result in results['playlists']:
+                print(f"{i}. {result['name']}")
+                result['type'] = 'playlist'
+                full_results.append(result)
+                i += 1
+            print(f"\n{Style.GREEN}ARTISTS{Style.RESET}")
+            for result in results['artists']:
+                print(f"{i}. {result['name']}")
+                result['type'] = 'artist'
+                full_results.append(result)
+                i += 1
+            print(f"\n{Style.GREEN}SHOWS{Style.RESET}")
+            for result in results['shows']:
+                print(f"{i}. {result['publisher']} - {result['name']}")
+                result['type'] = 'show'
+                full_results.append(result)
+                i += 1
+            print(f"\n{Style.GREEN}EPISODES{Style.RESET}")
+            for result in results['episodes']:
+                print(f"{i}. {result['release_date']} - {result['name']}")
+                result['type'] = 'episode'
+                full_results.append(result)
+                i += 1
+            print("")
+            print("Enter the number of the item you want to download")
+            print(f"allowed delimiters: {self.SEPARATORS}")
+            print("Enter 'all' to download all items")
+            print("Enter 'next' to show more results")
+            print("Enter 'exit' to exit")
             selection = input(">>>")
+            while selection == "":
+                selection = input(">>>")
+            if selection == "next":
+                offset += self.zs_api.limit
+                continue
+            break
         if selection == "exit":
             return False
         if selection == "all":
             for result in full_results:
-                if result['type'] == 'track':
-                    self.download_track(result['id'])
-                elif result['type'] == 'album':
-                    self.download_album(result['id'])
-                elif result['type'] == 'playlist':
-                    self.download_playlist(result['id'])
-                elif result['type'] == 'artist':
-                    self.download_artist(result['id'])
+                self.download_result(result)
             return True
         for item in self.split_input(selection):
             if int(item) >= len(full_results) + 1:
                 print("Invalid selection")
                 return False
-            result = full_results[int(item) - 1]
-            if result['type'] == 'track':
-                self.download_track(result['id'])
-            elif result['type'] == 'album':
-                self.download_album(result['id'])
-            elif result['type'] == 'playlist':
-                self.download_playlist(result['id'])
-            elif result['type'] == 'artist':
-                self.download_artist(result['id'])
+            self.download_result(full_results[int(item) - 1])
         return True
 
     def start(self):
@@ -871,11 +2236,24 @@ class ZSpotify:
             print(f"ZSpotify {__version__}")
             return
 
+        if self.plan is None and not self.args.resume:
+            previous = self.previous_journals()
+            if self.args.worker_id and any(journal.owner_alive() for journal in previous):
+                print(f"Worker {self.args.worker_id} is already running")
+                return
+            # Runs that are still going have their own journals, only the
+            # journal of an interrupted run is waiting to be resumed
+            if any(journal.interrupted() for journal in previous) and not self.args.discard_journal:
+                print("An earlier run was interrupted, continue it with --resume "
+                      "or start a new one with --discard-journal")
+                return
+
         self.splash()
         while not self.login():
             print("Invalid credentials")
 
         self.archive_migration()
+        self.start_journal()
 
         if self.args.all_playlists:
             self.download_all_user_playlists()
@@ -926,6 +2304,10 @@ class ZSpotify:
                     self.download_by_url(query)
                 else:
                     self.search(query)
+        if self.args.upgrade:
+            self.upgrade()
+        if self.args.execute_plan:
+            self.execute_plan(self.args.execute_plan)
         if self.args.bulk_download:
             with open(self.args.bulk_download, "r") as file:
                 for line in file:
@@ -941,16 +2323,41 @@ class ZSpotify:
             else:
                 print("Invalid input")
 
+        if self.plan is not None:
+            plan = self.make_plan(self.plan)
+            self.print_plan(plan)
+            if self.args.plan_file:
+                with open(self.args.plan_file, "w") as f:
+                    json.dump(plan, f, indent=4)
+                print(f"Plan saved to {self.args.plan_file}")
+        elif self.job_queue:
+            self.drain_job_queue()
+        self.finish_journal()
+
+        if self.args.watch and self.plan is None:
+            self.watch(self.args.watch)
+
 
 def main():
     """Creates an instance of ZSpotify"""
     zs = ZSpotify()
 
+    profiler = None
+    if zs.args.profile:
+        profiler = Profiler()
+        profiler.start()
+        tracer.enable()
     try:
         zs.start()
     except KeyboardInterrupt:
         print("Interrupted by user")
         sys.exit(0)
+    finally:
+        if profiler is not None:
+            profiler.stop(zs.args.profile)
+            trace_file = Path(zs.args.profile).with_suffix(".trace.json")
+            tracer.save(trace_file)
+            print(f"Profile saved to {zs.args.profile}, timeline saved to {trace_file}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Event, Thread
+
+import json
+import sqlite3
+import time
+
+
+class JobQueue(ABC):
+    """Shared queue of download jobs with leases
+
+    A worker must claim a job before working on it. The claim is a lease
+    that expires after lease_time seconds unless the worker renews it with
+    heartbeat(), so jobs held by crashed workers are claimed again by
+    others. Job ids are the Spotify track or episode id and the folder it
+    is downloaded to, see ZSpotify.job_key.
+    """
+
+    def __init__(self, lease_time=300, max_attempts=3):
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+
+    @abstractmethod
+    def claim(self, job_id, worker_id, payload=None):
+        """Adds the job if it is new and leases it, returns False if it is
+        done or leased by another worker"""
+
+    @abstractmethod
+    def claimable(self, job_id, worker_id):
+        """Returns True if claim() would lease the job, without leasing it"""
+
+    @abstractmethod
+    def claim_next(self, worker_id):
+        """Leases any claimable job, returns (job_id, payload) or None,
+        payload["id"] is the track or episode id"""
+
+    @abstractmethod
+    def renew(self, job_id, worker_id):
+        """Extends the lease, returns False if the lease was lost"""
+
+    @abstractmethod
+    def complete(self, job_id, worker_id):
+        """Marks the job done, it is never claimed again. Returns False if
+        the worker lost the lease, the job is then left to its new owner"""
+
+    @abstractmethod
+    def fail(self, job_id, worker_id):
+        """Releases the job so it can be retried, up to max_attempts"""
+
+    @abstractmethod
+    def active(self):
+        """Returns the number of jobs with a lease that has not expired"""
+
+    @contextmanager
+    def heartbeat(self, job_id, worker_id):
+        """Renews the lease of a job in the background while in the block"""
+        stop = Event()
+
+        def beat():
+            while not stop.wait(self.lease_time / 3):
+                if not self.renew(job_id, worker_id):
+                    print(f"Lost lease of {job_id}")
+                    return
+
+        beater = Thread(target=beat, daemon=True)
+        beater.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            beater.join()
+
+
+class SQLiteJobQueue(JobQueue):
+    """JobQueue stored in a SQLite database
+
+    Put the database on a volume shared by all workers. Every operation
+    opens its own connection, so a queue can be used from several threads.
+    Note that SQLite locking relies on the filesystem, some network
+    filesystems do not implement it correctly.
+    """
+
+    def __init__(self, file, lease_time=300, max_attempts=3):
+        super().__init__(lease_time, max_attempts)
+        self.file = Path(file)
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                       "id TEXT PRIMARY KEY, "
+                       "payload TEXT, "
+                       "state TEXT NOT NULL DEFAULT 'pending', "
+                       "worker TEXT, "
+                       "lease_expires REAL NOT NULL DEFAULT 0, "
+                       "attempts INTEGER NOT NULL DEFAULT 0)")
+
+    @contextmanager
+    def connect(self):
+        """Yields a connection inside an immediate (write locked) transaction"""
+        db = sqlite3.connect(self.file, timeout=60, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+
+    def claim(self, job_id, worker_id, payload=None):
+        now = time.time()
+        with self.connect() as db:
+            db.execute("INSERT OR IGNORE INTO jobs (id, payload) VALUES (?, ?)",
+                       (job_id, json.dumps(payload)))
+            cursor = db.execute(
+                "UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ? "
+                "WHERE id = ? AND (state = 'pending' OR (state = 'leased' "
+                "AND (lease_expires < ? OR worker = ?)))",
+                (worker_id, now + self.lease_time, job_id, now, worker_id))
+            return cursor.rowcount == 1
+
+    def claimable(self, job_id, worker_id):
+        with self.connect() as db:
+            row = db.execute("SELECT state, worker, lease_expires FROM jobs WHERE id = ?",
+                             (job_id,)).fetchone()
+        if row is None:
+            return True
+        state, worker, lease_expires = row
+        return state == "pending" or (state == "leased" and
+                                      (lease_expires < time.time() or worker == worker_id))
+
+    def claim_next(self, worker_id):
+        now = time.time()
+        with self.connect() as db:
+            row = db.execute(
+                "SELECT id, payload FROM jobs WHERE state = 'pending' "
+                "OR (state = 'leased' AND lease_expires < ?) LIMIT 1",
+                (now,)).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ? "
+                "WHERE id = ?",
+                (worker_id, now + self.lease_time, row[0]))
+            return row[0], json.loads(row[1])
+
+    def renew(self, job_id, worker_id):
+        with self.connect() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET lease_expires = ? "
+                "WHERE id = ? AND state = 'leased' AND worker = ?",
+                (time.time() + self.lease_time, job_id, worker_id))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker_id):
+        with self.connect() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET state = 'done' WHERE id = ? AND state = 'leased' AND worker = ?",
+                (job_id, worker_id))
+            return cursor.rowcount == 1
+
+    def fail(self, job_id, worker_id):
+        with self.connect() as db:
+            db.execute(
+                "UPDATE jobs SET attempts = attempts + 1, lease_expires = 0, "
+                "state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+                "WHERE id = ? AND worker = ?",
+                (self.max_attempts, job_id, worker_id))
+
+    def active(self):
+        with self.connect() as db:
+            return db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = 'leased' AND lease_expires >= ?",
+                (time.time(),)).fetchone()[0]
@@ -0,0 +1,204 @@
+from pathlib import Path
+
+import datetime
+import json
+import os
+import socket
+import threading
+
+
+def process_alive(pid):
+    """Returns whether the process pid of this host is running"""
+    if os.name == "nt":
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        # PROCESS_QUERY_LIMITED_INFORMATION, signals would terminate it
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            # Access denied, the process of another user
+            return kernel32.GetLastError() == 5
+        code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel32.CloseHandle(handle)
+        return code.value == 259  # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class RunJournal:
+    """Append-only log of a run, to resume it after a crash
+
+    Every line is a json event: the start of the run with its arguments,
+    jobs as they are resolved, their states (pending, fetched, converted,
+    tagged, done, failed) and the sources (playlists, albums...) that were
+    listed completely. Replaying the events gives the state of every job
+    without listing anything again. A torn last line, from a crash while
+    writing, is ignored.
+
+    Every run writes its own journal, the start and resume events record the
+    process owning it and the end event a run that finished with failed jobs.
+    """
+
+    STATES = ("pending", "fetched", "converted", "tagged", "done", "failed")
+
+    def __init__(self, file):
+        self.file = Path(file)
+        self.argv = None
+        self.jobs = {}
+        self.states = {}
+        self.data = {}
+        self.sources = set()
+        self.host = None
+        self.pid = None
+        self.ended = False
+        self._lock = threading.Lock()
+        self._f = None
+
+    @classmethod
+    def find(cls, directory, pattern="journal*.jsonl"):
+        """Returns the loaded journals of a directory, oldest first"""
+        journals = []
+        for file in Path(directory).glob(pattern):
+            journal = cls(file)
+            try:
+                mtime = file.stat().st_mtime
+                journal.load()
+            except OSError:
+                # Finished or discarded meanwhile
+                continue
+            journals.append((mtime, journal))
+        return [journal for _, journal in sorted(journals, key=lambda item: item[0])]
+
+    def exists(self):
+        return self.file.exists()
+
+    def is_open(self):
+        return self._f is not None
+
+    def load(self):
+        """Replays the events of the journal"""
+        with open(self.file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                kind = event.get("event")
+                if kind in ("start", "resume"):
+                    self.host = event.get("host")
+                    self.pid = event.get("pid")
+                    self.ended = False
+                if kind == "start":
+                    self.argv = event["argv"]
+                elif kind == "end":
+                    self.ended = True
+                elif kind == "job":
+                    self.jobs[event["key"]] = (event["id"], event["payload"])
+                    self.states.setdefault(event["key"], "pending")
+                elif kind == "state":
+                    self.states[event["key"]] = event["state"]
+                    if event.get("data"):
+                        self.data[event["key"]] = event["data"]
+                elif kind == "source":
+                    self.sources.add(event["source"])
+
+    def start(self, argv):
+        """Starts the journal of a new run, replacing the previous one"""
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self._f = open(self.file, "w", encoding="utf-8", buffering=1)
+        self.argv = argv
+        self.write({"event": "start", "argv": argv, **self._owner()})
+
+    def resume(self):
+        """Appends the events of this run to the loaded journal"""
+        self._f = open(self.file, "a", encoding="utf-8", buffering=1)
+        self.write({"event": "resume", **self._owner()})
+
+    def _owner(self):
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.ended = False
+        return {"host": self.host, "pid": self.pid,
+                "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+
+    def owner_alive(self):
+        """Returns whether the process that wrote the journal may still be
+        running, the processes of other hosts are assumed to be"""
+        if self.pid is None:
+            return False
+        if self.host != socket.gethostname():
+            return True
+        return self.pid == os.getpid() or process_alive(self.pid)
+
+    def interrupted(self):
+        """Returns whether the run of the journal stopped before its end"""
+        return not self.ended and not self.owner_alive()
+
+    def resumable(self):
+        return self.argv is not None and not self.owner_alive() and (
+            not self.ended or bool(self.failed()))
+
+    def write(self, event):
+        with self._lock:
+            # Line buffered, every event reaches the file before the next one
+            self._f.write(json.dumps(event) + "\n")
+
+    def add_job(self, key, job_id, payload):
+        if key in self.jobs:
+            return
+        self.jobs[key] = (job_id, payload)
+        self.states[key] = "pending"
+        self.write({"event": "job", "key": key, "id": job_id, "payload": payload})
+
+    def set_state(self, key, state, data=None):
+        """Records the state of a job, data is what is needed to finish it
+        from that state"""
+        self.states[key] = state
+        event = {"event": "state", "key": key, "state": state}
+        if data:
+            self.data[key] = data
+            event["data"] = data
+        self.write(event)
+
+    def state(self, key):
+        return self.states.get(key)
+
+    def source_done(self, source):
+        self.sources.add(source)
+        self.write({"event": "source", "source": source})
+
+    def is_source_done(self, source):
+        return source in self.sources
+
+    def unfinished(self):
+        """Returns the jobs that did not finish nor fail, in order"""
+        return {key: job for key, job in self.jobs.items()
+                if self.states.get(key) not in ("done", "failed")}
+
+    def failed(self):
+        return {key: job for key, job in self.jobs.items() if self.states.get(key) == "failed"}
+
+    def end(self):
+        """Closes the journal of a run that finished with failed jobs"""
+        self.ended = True
+        self.write({"event": "end"})
+        self.close()
+
+    def discard(self):
+        """Keeps the journal of an abandoned run as <file>.prev"""
+        self.file.replace(self.file.with_name(self.file.name + ".prev"))
+
+    def finish(self):
+        """Removes the journal of a run that completed"""
+        self.close()
+        self.file.unlink()
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
@@ -0,0 +1,123 @@
+from contextlib import contextmanager
+from functools import wraps
+
+import json
+import os
+import sys
+import threading
+import time
+
+
+class Tracer:
+    """Records timed spans as Chrome trace events
+
+    The saved file can be loaded in chrome://tracing or ui.perfetto.dev,
+    every thread gets its own row. Recording is off until enable() is
+    called, spans are then only a clock read and a list append.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.threads = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def enable(self):
+        self._start = time.perf_counter()
+        self.enabled = True
+
+    @contextmanager
+    def span(self, name, **args):
+        """Records the time spent in the block"""
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started, time.perf_counter(), args)
+
+    def record(self, name, started, ended, args=None):
+        thread = threading.current_thread()
+        event = {"name": name,
+                 "ph": "X",
+                 "pid": os.getpid(),
+                 "tid": thread.ident,
+                 "ts": (started - self._start) * 1e6,
+                 "dur": (ended - started) * 1e6,
+                 "args": args or {}}
+        with self._lock:
+            self.threads[thread.ident] = thread.name
+            self.events.append(event)
+
+    def save(self, file):
+        """Writes the spans in the Chrome trace event format"""
+        with self._lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        names = [{"name": "thread_name",
+                  "ph": "M",
+                  "pid": os.getpid(),
+                  "tid": tid,
+                  "args": {"name": name}} for tid, name in threads.items()]
+        with open(file, "w") as f:
+            json.dump({"traceEvents": names + events, "displayTimeUnit": "ms"}, f)
+
+
+tracer = Tracer()
+
+
+def traced(name):
+    """Decorates a method to record a span of each call, the first argument
+    (a track id or a file) is added to the span"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            span_args = {"arg": str(args[1])} if len(args) > 1 else {}
+            with tracer.span(name, **span_args):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Profiler:
+    """cProfile of every thread of a run
+
+    Before Python 3.12 a profile only sees the thread that enabled it, so
+    threads started afterwards get their own profiles, merged on save.
+    """
+
+    def __init__(self):
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def _profile_thread(self, frame, event, arg):
+        import cProfile
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(profile)
+        # Replaces this hook with the profiler for the rest of the thread
+        profile.enable()
+
+    def start(self):
+        import cProfile
+        profile = cProfile.Profile()
+        self.profiles.append(profile)
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._profile_thread)
+        profile.enable()
+
+    def stop(self, file):
+        """Saves the merged profile to file and prints the slowest functions"""
+        threading.setprofile(None)
+        self.profiles[0].disable()
+        import pstats
+        with self._lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(file)
+        stats.sort_stats("cumulative").print_stats(25)
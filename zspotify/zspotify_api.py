@@ -1,17 +1,305 @@
+try:
+    from .tracing import traced
+except ImportError:
+    from tracing import traced
+
 from io import BytesIO
-from librespot.audio.decoders import AudioQuality, VorbisOnlyAudioQuality
-from librespot.core import ApiClient, Session
-from librespot.metadata import TrackId, EpisodeId
 from pathlib import Path
-from pydub import AudioSegment
 
 import json
+import math
 import os
+import random
 import re
-import requests
 import shutil
+import tempfile
+import threading
 import time
 
+# librespot, pydub and requests are slow to import, so they are imported on
+# first use inside the methods that need them. This keeps `zspotify --version`
+# and argument errors fast.
+
+REPLAYGAIN_REFERENCE = -18.0
+# Momentary loudness of every 400ms block, printed by ffmpeg's ebur128 filter
+# every 100ms, which are the overlapping gating blocks of ITU-R BS.1770
+LOUDNESS_BLOCK = re.compile(rb"\bM:\s*(-?(?:[\d.]+|inf))")
+PCM_FORMATS = {1: "u8", 2: "s16le", 3: "s24le", 4: "s32le"}
+SEARCH_TYPES = "track,album,playlist,artist,show,episode"
+# librespot fetches CDN streams in chunks of this size, one range request each
+STREAM_CHUNK_SIZE = 128 * 1024
+
+
+class Record:
+    """Compact item of a listing
+
+    Subclasses declare their fields in __slots__, so a record takes a
+    fraction of the memory of a dict. Records can still be read like the
+    dicts they replace: record["id"], record.get("added_at").
+    """
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        for field, value in zip(self.__slots__, args):
+            setattr(self, field, value)
+        for field in self.__slots__[len(args):]:
+            setattr(self, field, kwargs.get(field))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()})"
+
+
+class TrackRecord(Record):
+    __slots__ = ("id", "name", "artist", "added_at", "artist_ids")
+
+
+class PlaylistRecord(Record):
+    __slots__ = ("id", "name", "owner", "snapshot_id")
+
+
+class DownloadJob(Record):
+    """A download submitted with download_many, progress is a dict updated
+    while it runs and future resolves to its DownloadResult"""
+    __slots__ = ("id", "output_path", "progress", "future")
+
+
+class DownloadResult(Record):
+    """Outcome of a download, error is the exception if it failed"""
+    __slots__ = ("id", "output_path", "ok", "error", "loudness", "stats", "seconds")
+
+
+class AdaptiveReader:
+    """Chunk sizing and stall handling for reading an audio stream
+
+    The chunk size follows the measured throughput so that each read takes
+    about target_read_time seconds. An empty read is a stall: the caller
+    waits backoff() seconds, a jittered delay that grows exponentially, and
+    the reader gives up after max_stalls stalls in a row.
+    """
+
+    def __init__(self, total_size, chunk_size=50000, min_chunk_size=8192,
+                 max_chunk_size=1024 * 1024, target_read_time=0.25,
+                 max_stalls=30, backoff_base=0.05, backoff_max=5.0):
+        self.total_size = total_size
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.target_read_time = target_read_time
+        self.max_stalls = max_stalls
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.downloaded = 0
+        # Bytes per second, exponential moving average of the last reads
+        self.throughput = 0.0
+        self.stalls = 0
+        self.total_stalls = 0
+        self.started = time.monotonic()
+
+    @property
+    def complete(self):
+        return self.downloaded >= self.total_size
+
+    @property
+    def stalled(self):
+        return self.stalls > 0
+
+    @property
+    def done(self):
+        return self.complete or self.stalls > self.max_stalls
+
+    def next_chunk_size(self):
+        return max(1, min(self.chunk_size, self.total_size - self.downloaded))
+
+    def record(self, size, elapsed):
+        """Records a read of size bytes that took elapsed seconds"""
+        if size == 0:
+            self.stalls += 1
+            self.total_stalls += 1
+            return
+        self.stalls = 0
+        self.downloaded += size
+        sample = size / max(elapsed, 1e-6)
+        self.throughput = sample if not self.throughput else 0.3 * sample + 0.7 * self.throughput
+        self.chunk_size = int(min(self.max_chunk_size,
+                                  max(self.min_chunk_size, self.throughput * self.target_read_time)))
+
+    def backoff(self):
+        """Returns the seconds to wait after a stall"""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (self.stalls - 1))
+        return delay * random.uniform(0.5, 1.5)
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {"bytes_per_second": self.downloaded / elapsed if elapsed else 0.0,
+                "last_bytes_per_second": self.throughput,
+                "seconds": elapsed,
+                "stalls": self.total_stalls,
+                "complete": self.complete}
+
+
+class RetryPolicy:
+    """Retries of Web API requests, shared by every thread using the api
+
+    Requests are grouped in endpoint classes ("tracks", "playlists", "me"...).
+    A 429 pauses the whole class for its Retry-After, so one throttled thread
+    slows all of them down instead of each one hitting the limit again.
+    After failure_threshold failures in a row (connection errors, timeouts,
+    5xx) the circuit of the class opens: its requests fail immediately for
+    cooldown seconds. Then it is half open, a single request is let through
+    to probe it while the others keep failing, and the result of the probe
+    closes the circuit or opens it again. A probe that does not report
+    within timeout seconds gives its slot to the next request.
+    """
+
+    def __init__(self, max_retries=5, backoff_base=0.5, backoff_max=30.0,
+                 failure_threshold=5, cooldown=30.0, timeout=30.0):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._open_until = {}
+        self._probe_until = {}
+        self._paused_until = {}
+
+    @staticmethod
+    def endpoint_class(url):
+        """Returns the first path segment of a Web API url, the host otherwise"""
+        match = re.match(r"https?://([^/]+)(?:/v1/([^/?]+))?", url)
+        if not match:
+            return url
+        return match.group(2) or match.group(1)
+
+    def delay(self, endpoint):
+        """Returns the seconds to wait before a request to endpoint, raises if
+        its circuit is open"""
+        now = time.monotonic()
+        with self._lock:
+            if endpoint in self._open_until:
+                if self._open_until[endpoint] > now:
+                    raise RuntimeError(
+                        f"Too many failures requesting {endpoint}, retrying in "
+                        f"{self._open_until[endpoint] - now:.0f}s")
+                if self._probe_until.get(endpoint, 0) > now:
+                    raise RuntimeError(
+                        f"Too many failures requesting {endpoint}, waiting for a probe")
+                # Half open, this request is the probe
+                self._probe_until[endpoint] = now + self.timeout
+            return max(0.0, self._paused_until.get(endpoint, 0) - now)
+
+    def wait(self, endpoint):
+        delay = self.delay(endpoint)
+        if delay:
+            time.sleep(delay)
+
+    def backoff(self, attempt):
+        """Returns the seconds to wait before retry number attempt, with full jitter"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def throttle(self, endpoint, retry_after):
+        """Pauses every request to endpoint for retry_after seconds"""
+        with self._lock:
+            self._paused_until[endpoint] = max(self._paused_until.get(endpoint, 0),
+                                               time.monotonic() + retry_after)
+
+    def success(self, endpoint):
+        with self._lock:
+            self._failures[endpoint] = 0
+            self._open_until.pop(endpoint, None)
+            self._probe_until.pop(endpoint, None)
+
+    def failure(self, endpoint):
+        with self._lock:
+            failures = self._failures.get(endpoint, 0) + 1
+            self._failures[endpoint] = failures
+            if failures >= self.failure_threshold:
+                # Also when a probe fails, failures are only reset by a success
+                self._open_until[endpoint] = time.monotonic() + self.cooldown
+                self._probe_until.pop(endpoint, None)
+
+    def retry_after(self, response, attempt):
+        """Returns the seconds asked by a 429 response, a backoff if it did not say"""
+        value = response.headers.get("Retry-After")
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                from email.utils import parsedate_to_datetime
+                try:
+                    return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        return self.backoff(attempt)
+
+
+class RateLimiter:
+    """Token bucket limiting the bytes per second of everyone sharing it
+
+    Callers report the bytes they transferred and sleep the returned delay,
+    so concurrent downloads split the rate between them. rate is in bytes
+    per second, None for no limit, and can be changed while in use.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self._rate = None
+        self._burst = burst
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self.rate = rate
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        with self._lock:
+            self._rate = rate or None
+            # Allows about a second of traffic at once
+            self._tokens = min(self._tokens, self.burst)
+
+    @property
+    def burst(self):
+        return self._burst or self._rate or 0.0
+
+    def reserve(self, size):
+        """Takes size bytes from the bucket, returns the seconds to wait for them"""
+        with self._lock:
+            if not self._rate:
+                return 0.0
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            # The bucket can go in debt, the wait pays it back
+            self._tokens -= size
+            return max(0.0, -self._tokens / self._rate)
+
+    def consume(self, size):
+        """Waits until size bytes fit in the rate"""
+        delay = self.reserve(size)
+        if delay:
+            time.sleep(delay)
+
 
 class ZSpotifyApi:
 
@@ -26,7 +314,16 @@ class ZSpotifyApi:
                  credentials='',
                  limit=20,
                  reintent_download=30,
-                 default_retries=10
+                 default_retries=10,
+                 account_cache_ttl=24 * 60 * 60,
+                 replaygain=False,
+                 search_cache_ttl=10 * 60,
+                 http_cache_dir=None,
+                 retry_policy=None,
+                 max_bandwidth=None,
+                 max_api_bandwidth=None,
+                 stream_ttl=5 * 60,
+                 parallel_ranges=4
                  ):
         self._version = "1.10.0"
         self.sanitize = sanitize
@@ -42,12 +339,49 @@ class ZSpotifyApi:
             self.credentials = Path(credentials)
         self.limit = limit
         self.reintent_download = reintent_download
-        self.quality = AudioQuality.HIGH
-        requests.adapters.DEFAULT_RETRIES = default_retries
+        self.default_retries = default_retries
+        self.account_cache_ttl = account_cache_ttl
+        self.account_cache = self.config_dir / "account.json"
+        self._quality = None
         self.session = None
         self.token = None
         self.token_for_saved = None
         self.progress = False
+        self.replaygain = replaygain
+        self.loudness = {}
+        # Throughput and stalls of the last download of every track
+        self.stream_stats = {}
+        self.http_cache_dir = Path(http_cache_dir) if http_cache_dir else None
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        # Shared by every download and thread, in bytes per second
+        self.bandwidth = RateLimiter(max_bandwidth)
+        self.api_bandwidth = RateLimiter(max_api_bandwidth)
+        # Genres of every artist looked up during the run
+        self.artist_genres = {}
+        self._artist_lock = threading.Lock()
+        self._token_lock = threading.Lock()
+        self.search_cache_ttl = search_cache_ttl
+        self.search_cache = {}
+        self._search_lock = threading.Lock()
+        self._search_executor = None
+        # Streams opened ahead of their download, id to (opened at, future)
+        self.stream_ttl = stream_ttl
+        self.parallel_ranges = parallel_ranges
+        self.prefetched_streams = {}
+        self._stream_lock = threading.Lock()
+        self._stream_executor = None
+
+    @property
+    def quality(self):
+        """AudioQuality used for downloads, HIGH until check_premium runs"""
+        if self._quality is None:
+            from librespot.audio.decoders import AudioQuality
+            self._quality = AudioQuality.HIGH
+        return self._quality
+
+    @quality.setter
+    def quality(self, value):
+        self._quality = value
 
     # UTILS
     def sanitize_data(self, value):
@@ -57,12 +391,22 @@ class ZSpotifyApi:
         return value.replace("|", "-")
 
     def init_token(self):
+        from librespot.core import Session
         self.session = Session.Builder().stored_file(stored_credentials=str(self.credentials)).create()
         self.token = self.session.tokens().get("user-read-email")
         self.token_for_saved = self.session.tokens().get("user-library-read")
 
+    def refresh_token(self, expired):
+        """Logs in again for a new token, unless another thread already
+        replaced the expired one, so concurrent 401s log in only once"""
+        with self._token_lock:
+            if self.token == expired:
+                print("Token expired, refreshing...")
+                self.init_token()
+
     def login(self, username=None, password=None):
         """Authenticates with Spotify and saves credentials to a file"""
+        from librespot.core import Session
 
         Path(self.credentials).parent.mkdir(parents=True, exist_ok=True)
 
@@ -90,11 +434,45 @@ class ZSpotifyApi:
         else:
             return False
 
+    def get_account_type(self):
+        """Returns the account type, cached on disk for account_cache_ttl seconds
+
+        None if Spotify did not send it, which is not cached."""
+        username = self.session.username()
+        cache = {}
+        if self.account_cache.is_file():
+            try:
+                with open(self.account_cache, "r") as f:
+                    cache = json.load(f)
+            except Exception as e:
+                print("Error loading account cache: {}".format(e))
+
+        cached = cache.get(username)
+        if cached and time.time() - cached["timestamp"] < self.account_cache_ttl:
+            return cached["type"]
+
+        # The product info arrives shortly after login
+        account_type = self.session.get_user_attribute("type")
+        for _ in range(10):
+            if account_type is not None:
+                break
+            time.sleep(0.2)
+            account_type = self.session.get_user_attribute("type")
+        if account_type is None:
+            return None
+        cache[username] = {"type": account_type, "timestamp": time.time()}
+        try:
+            with open(self.account_cache, "w") as f:
+                json.dump(cache, f, indent=4)
+        except OSError as e:
+            print("Error saving account cache: {}".format(e))
+        return account_type
+
     def check_premium(self):
         """If user has spotify premium return true"""
+        from librespot.audio.decoders import AudioQuality
         if self.session is not None:
-            if self.session.get_user_attribute(
-                    "type") == "premium" or self.force_premium:
+            if self.force_premium or self.get_account_type() == "premium":
                 self.quality = AudioQuality.VERY_HIGH
                 print("[ DETECTED PREMIUM ACCOUNT - USING VERY_HIGH QUALITY ]\n")
             else:
@@ -201,22 +579,114 @@ class ZSpotifyApi:
                 'playlist': playlist_id_str, 'episode': episode_id_str,
                 'show': show_id_str, 'artist': artist_id_str}
 
-    def authorized_get_request(self, url, retry_count=0, **kwargs):
-        """Makes a request to the Spotify API with the authorization token"""
-        if retry_count > 3:
-            raise RuntimeError("Connection Error: Too many retries")
+    def authorized_get_request(self, url, **kwargs):
+        """Makes a request to the Spotify API with the authorization token
+
+        Connection errors, timeouts, 429 and 5xx responses are retried as
+        set by retry_policy, other errors raise requests.HTTPError.
+
+        With http_cache_dir set, responses with an ETag or Last-Modified
+        header are stored and revalidated with a conditional request, a 304
+        is answered from the stored body."""
+        import requests
+        requests.adapters.DEFAULT_RETRIES = self.default_retries
+        policy = self.retry_policy
+        endpoint = policy.endpoint_class(url)
+        kwargs.setdefault("timeout", policy.timeout)
+
+        cache_file = self.http_cache_file(url, kwargs.get("params"))
+        cached = self.http_cache_load(cache_file)
+        refreshed = False
+        for attempt in range(policy.max_retries + 1):
+            policy.wait(endpoint)
+            token = self.token
+            headers = {"Authorization": f"Bearer {token}"}
+            if cached is not None:
+                if cached.get("etag"):
+                    headers["If-None-Match"] = cached["etag"]
+                if cached.get("last_modified"):
+                    headers["If-Modified-Since"] = cached["last_modified"]
 
-        try:
-            response = requests.get(url,
-                                    headers={"Authorization": f"Bearer {self.token}"},
-                                    **kwargs)
-            if response.status_code == 401:
-                print("Token expired, refreshing...")
-                self.init_token()
-                return self.authorized_get_request(url, retry_count + 1, **kwargs)
+            try:
+                response = requests.get(url, headers=headers, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                policy.failure(endpoint)
+                print(f"Request to {endpoint} failed ({e}), retrying...")
+                time.sleep(policy.backoff(attempt))
+                continue
+
+            if response.status_code == 401 and not refreshed:
+                self.refresh_token(token)
+                refreshed = True
+                continue
+            if response.status_code == 429:
+                retry_after = policy.retry_after(response, attempt)
+                print(f"Rate limited on {endpoint}, waiting {retry_after:.0f}s...")
+                policy.throttle(endpoint, retry_after)
+                continue
+            if response.status_code >= 500:
+                policy.failure(endpoint)
+                time.sleep(policy.backoff(attempt))
+                continue
+
+            policy.success(endpoint)
+            self.api_bandwidth.consume(len(response.content))
+            if response.status_code == 304 and cached is not None:
+                return self.http_cache_response(response, cached)
+            response.raise_for_status()
+            if response.status_code == 200 and cache_file is not None:
+                self.http_cache_store(cache_file, response)
             return response
-        except requests.exceptions.ConnectionError:
-            return self.authorized_get_request(url, retry_count + 1, **kwargs)
+        raise RuntimeError(f"Connection Error: Too many retries requesting {endpoint}")
+
+    # HTTP CACHE
+    def http_cache_file(self, url, params=None):
+        """Returns the cache file of a request, None if the cache is disabled"""
+        if self.http_cache_dir is None:
+            return None
+        import hashlib
+        key = url + "?" + json.dumps(params or {}, sort_keys=True, default=str)
+        return self.http_cache_dir / (hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def http_cache_load(self, cache_file):
+        if cache_file is None or not cache_file.is_file():
+            return None
+        try:
+            with open(cache_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print("Error loading http cache: {}".format(e))
+            return None
+
+    def http_cache_store(self, cache_file, response):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        self.http_cache_dir.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so concurrent readers never see a
+        # partial entry
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"etag": etag,
+                       "last_modified": last_modified,
+                       "content_type": response.headers.get("Content-Type"),
+                       "body": response.text}, f)
+        os.replace(tmp_file, cache_file)
+
+    def http_cache_response(self, not_modified, cached):
+        """Returns a 200 response with the cached body for a 304 response"""
+        import requests
+        response = requests.Response()
+        response.status_code = 200
+        response.url = not_modified.url
+        response.request = not_modified.request
+        response.headers.update(not_modified.headers)
+        if cached.get("content_type"):
+            response.headers["Content-Type"] = cached["content_type"]
+        response.encoding = "utf-8"
+        response._content = cached["body"].encode("utf-8")
+        return response
 
     def conv_artist_format(self, artists):
         """Returns converted artist format"""
@@ -231,17 +701,141 @@ class ZSpotifyApi:
 
     # Functions directly related to modifying the downloaded audio and its
     # metadata
-    def convert_audio_format(self, audio_bytes: BytesIO, output_path):
-        """Converts raw audio (ogg vorbis) to user specified format"""
+    def get_bitrate(self):
+        """Returns the bitrate of the converted files for the current quality"""
+        from librespot.audio.decoders import AudioQuality
+        if self.quality == AudioQuality.VERY_HIGH:
+            return "320k"
+        return "160k"
+
+    def output_paths(self, output_path):
+        """Returns a dict of audio format to path
+
+        output_path is either a path, in music_format, or already a dict of
+        audio format to path"""
+        if isinstance(output_path, dict):
+            return output_path
+        return {self.music_format: output_path}
+
+    def create_output_dirs(self, output_path, make_dirs=True):
+        """Creates the parent directories of every output path"""
+        for path in self.output_paths(output_path).values():
+            _dirs_path = path.parent
+            if make_dirs:
+                _dirs_path.mkdir(parents=True, exist_ok=True)
+            elif not _dirs_path.exists():
+                raise FileNotFoundError(
+                    f"Directory {str(_dirs_path)} does not exist")
+
+    @traced("convert_audio_format")
+    def convert_audio_format(self, audio_bytes: BytesIO, output_path, tags=None, cover=None):
+        """Converts raw audio (ogg vorbis) to user specified format
+
+        The audio is decoded once, when output_path is a dict of audio format
+        to path every format is encoded from it in parallel. tags (ffmpeg
+        metadata names) and cover (image bytes, mp3 only) are written by the
+        encoder, so the file does not have to be rewritten to tag it. Returns
+        the loudness analysis of the audio if replaygain is enabled."""
+        from concurrent.futures import ThreadPoolExecutor
+        from pydub import AudioSegment
         audio_segment = AudioSegment.from_file(audio_bytes)
 
-        bitrate = "160k"
-        if self.quality == AudioQuality.VERY_HIGH:
-            bitrate = "320k"
+        analysis = None
+        if self.replaygain:
+            analysis = self.analyze_loudness(audio_segment)
+            if tags is not None:
+                tags = {**tags, **self.replaygain_tags([analysis])}
+
+        bitrate = self.get_bitrate()
 
-        audio_segment.export(output_path, format=self.music_format, bitrate=bitrate)
+        cover_path = None
+        if cover:
+            with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+                f.write(cover)
+                cover_path = f.name
+
+        def export(music_format, path):
+            audio_segment.export(path, format=music_format, bitrate=bitrate, tags=tags,
+                                 cover=cover_path if music_format == "mp3" else None)
+
+        try:
+            outputs = self.output_paths(output_path)
+            if len(outputs) == 1:
+                for music_format, path in outputs.items():
+                    export(music_format, path)
+                return analysis
+
+            # Every export runs its own ffmpeg process, so threads are enough to
+            # encode the formats in parallel
+            with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+                exports = [executor.submit(export, music_format, path)
+                           for music_format, path in outputs.items()]
+                for future in exports:
+                    future.result()
+            return analysis
+        finally:
+            if cover_path:
+                os.remove(cover_path)
+
+    def analyze_loudness(self, audio_segment):
+        """Returns the K-weighted loudness (LUFS) of the 400ms blocks of the
+        audio and its sample peak relative to full scale
+
+        Blocks are measured by ffmpeg's ebur128 filter (ITU-R BS.1770, the
+        channels are summed), which pydub already requires."""
+        import subprocess
+        from pydub import AudioSegment
+        result = subprocess.run(
+            [AudioSegment.converter, "-nostats", "-hide_banner",
+             "-f", PCM_FORMATS[audio_segment.sample_width],
+             "-ar", str(audio_segment.frame_rate),
+             "-ac", str(audio_segment.channels),
+             "-i", "pipe:0", "-af", "ebur128", "-f", "null", "-"],
+            input=audio_segment.raw_data, capture_output=True, check=True)
+        return {"blocks": [float(block) for block in LOUDNESS_BLOCK.findall(result.stderr)],
+                "peak": audio_segment.max / audio_segment.max_possible_amplitude}
+
+    @staticmethod
+    def integrated_loudness(blocks):
+        """Returns the gated loudness (LUFS) of blocks, None for silence
+
+        Blocks below -70 LUFS, then blocks 10 LU below the loudness of the
+        remaining ones, are left out (ITU-R BS.1770-4)."""
+        def power_mean(loudness):
+            return 10 * math.log10(sum(10 ** (block / 10) for block in loudness) / len(loudness))
+
+        gated = [block for block in blocks if block > -70]
+        if not gated:
+            return None
+        threshold = power_mean(gated) - 10
+        return power_mean([block for block in gated if block > threshold])
+
+    def replaygain_values(self, analyses):
+        """Returns the ReplayGain (gain in dB, peak) of one or more analyses
+
+        Several analyses, e.g. the tracks of an album, are gated together as
+        one program. The gain brings the integrated loudness to the
+        ReplayGain 2.0 reference level of -18 LUFS."""
+        if not analyses:
+            return None
+        loudness = self.integrated_loudness(
+            [block for analysis in analyses for block in analysis["blocks"]])
+        peak = max(analysis["peak"] for analysis in analyses)
+        if loudness is None:
+            return 0.0, peak
+        return REPLAYGAIN_REFERENCE - loudness, peak
+
+    def replaygain_tags(self, analyses, kind="TRACK"):
+        """Returns the ReplayGain tags of kind TRACK or ALBUM"""
+        values = self.replaygain_values(analyses)
+        if values is None:
+            return {}
+        gain, peak = values
+        return {f"REPLAYGAIN_{kind}_GAIN": f"{gain:.2f} dB",
+                f"REPLAYGAIN_{kind}_PEAK": f"{peak:.6f}"}
 
     # INFO
+    @traced("get_audio_info")
     def get_audio_info(self, track_id, get_genres=False):
         """Retrieves metadata for downloaded songs"""
         try:
@@ -253,45 +847,90 @@ class ZSpotifyApi:
                     + "&market=from_token"
                 ).text
             )
+            track = info["tracks"][0]
+            if get_genres:
+                self.get_artist_genres([artist["id"] for artist in track["artists"]])
+            return self.parse_audio_info(track_id, track, get_genres)
+        except Exception as e:
+            print("###   get_song_info - FAILED TO QUERY METADATA   ###")
+            print("track_id:", track_id)
+            print(e)
+            return None
 
-            # Sum the size of the images, compares and saves the index of the
-            # largest image size
-            sum_total = []
-            for sum_px in info['tracks'][0]['album']['images']:
-                sum_total.append(sum_px['height'] + sum_px['width'])
-
-            img_index = sum_total.index(max(sum_total)) if sum_total else -1
-
-            artist_id = info['tracks'][0]['artists'][0]['id']
-            artists = []
-            for data in info["tracks"][0]["artists"]:
-                artists.append(self.sanitize_data(data["name"]))
-            artist_name = artists
-            album_name = self.sanitize_data(info["tracks"][0]["album"]["name"])
-            song_name = self.sanitize_data(info["tracks"][0]["name"])
-            image_url = info["tracks"][0]["album"]["images"][img_index]["url"] if img_index >= 0 else None
-            release_year = info["tracks"][0]["album"]["release_date"].split("-")[0]
-            disc_number = info["tracks"][0]["disc_number"]
-            track_number = info["tracks"][0]["track_number"]
-            scraped_song_id = info["tracks"][0]["id"]
-            is_playable = info["tracks"][0]["is_playable"]
-            release_date = info["tracks"][0]["album"]["release_date"]
+    def get_audio_infos(self, track_ids, get_genres=False):
+        """Retrieves metadata for many songs, 50 per request
+
+        Returns a dict of track id to metadata, None for the tracks that could
+        not be found"""
+        infos = {}
+        for i in range(0, len(track_ids), 50):
+            batch = track_ids[i:i + 50]
+            resp = self.authorized_get_request(
+                "https://api.spotify.com/v1/tracks",
+                params={"ids": ",".join(batch), "market": "from_token"}).json()
             if get_genres:
-                genres = 'Test_genre'
-                return {'id': track_id,
-                        'artist_id': artist_id,
-                        'artist_name': self.conv_artist_format(artist_name),
-                        'album_name': album_name,
-                        'audio_name': song_name,
-                        'image_url': image_url,
-                        'release_year': release_year,
-                        'disc_number': disc_number,
-                        'audio_number': track_number,
-                        'scraped_song_id': scraped_song_id,
-                        'is_playable': is_playable,
-                        'release_date': release_date,
-                        'genres': genres}
+                self.get_artist_genres([artist["id"] for track in resp["tracks"] if track
+                                        for artist in track["artists"]])
+            for track_id, track in zip(batch, resp["tracks"]):
+                infos[track_id] = self.parse_audio_info(track_id, track, get_genres) if track else None
+        return infos
+
+    def get_artist_genres(self, artist_ids):
+        """Returns a dict of artist id to genres
+
+        Artists are looked up 50 per request and remembered for the rest of
+        the run, so tagging a whole library takes one request per 50 distinct
+        artists. Pass the artist ids of a listing ahead of time to batch
+        them."""
+        artist_ids = [artist_id for artist_id in dict.fromkeys(artist_ids) if artist_id]
+        with self._artist_lock:
+            missing = [artist_id for artist_id in artist_ids if artist_id not in self.artist_genres]
+        for i in range(0, len(missing), 50):
+            batch = missing[i:i + 50]
+            resp = self.authorized_get_request(
+                "https://api.spotify.com/v1/artists",
+                params={"ids": ",".join(batch)}).json()
+            with self._artist_lock:
+                for artist_id, artist in zip(batch, resp["artists"]):
+                    self.artist_genres[artist_id] = artist["genres"] if artist else []
+        with self._artist_lock:
+            return {artist_id: self.artist_genres.get(artist_id, []) for artist_id in artist_ids}
+
+    def genres_of(self, artist_ids):
+        """Returns the genres of the artists of a track, without duplicates"""
+        genres = []
+        for artist_genres in self.get_artist_genres(artist_ids).values():
+            for genre in artist_genres:
+                if genre not in genres:
+                    genres.append(genre)
+        return genres
+
+    def parse_audio_info(self, track_id, track, get_genres=False):
+        """Returns the metadata of a track object from the tracks endpoint"""
+        # Sum the size of the images, compares and saves the index of the
+        # largest image size
+        sum_total = []
+        for sum_px in track['album']['images']:
+            sum_total.append(sum_px['height'] + sum_px['width'])
+
+        img_index = sum_total.index(max(sum_total)) if sum_total else -1
 
+        artist_id = track['artists'][0]['id']
+        artists = []
+        for data in track["artists"]:
+            artists.append(self.sanitize_data(data["name"]))
+        artist_name = artists
+        album_name = self.sanitize_data(track["album"]["name"])
+        song_name = self.sanitize_data(track["name"])
+        image_url = track["album"]["images"][img_index]["url"] if img_index >= 0 else None
+        release_year = track["album"]["release_date"].split("-")[0]
+        disc_number = track["disc_number"]
+        track_number = track["track_number"]
+        scraped_song_id = track["id"]
+        is_playable = track["is_playable"]
+        release_date = track["album"]["release_date"]
+        artist_ids = [data["id"] for data in track["artists"]]
+        if get_genres:
             return {'id': track_id,
                     'artist_id': artist_id,
                     'artist_name': self.conv_artist_format(artist_name),
@@ -303,62 +942,94 @@ class ZSpotifyApi:
                     'audio_number': track_number,
                     'scraped_song_id': scraped_song_id,
                     'is_playable': is_playable,
-                    'release_date': release_date}
-        except Exception as e:
-            print("###   get_song_info - FAILED TO QUERY METADATA   ###")
-            print("track_id:", track_id)
-            print(e)
-            return None
+                    'release_date': release_date,
+                    'duration_ms': track["duration_ms"],
+                    'isrc': track.get("external_ids", {}).get("isrc"),
+                    'artist_ids': artist_ids,
+                    'genres': self.genres_of(artist_ids)}
+
+        return {'id': track_id,
+                'artist_id': artist_id,
+                'artist_name': self.conv_artist_format(artist_name),
+                'album_name': album_name,
+                'audio_name': song_name,
+                'image_url': image_url,
+                'release_year': release_year,
+                'disc_number': disc_number,
+                'audio_number': track_number,
+                'scraped_song_id': scraped_song_id,
+                'is_playable': is_playable,
+                'release_date': release_date,
+                'duration_ms': track["duration_ms"],
+                'isrc': track.get("external_ids", {}).get("isrc"),
+                'artist_ids': artist_ids}
 
     def get_all_user_playlists(self):
         """Returns list of users playlists"""
-        playlists = []
-        limit = 50
+        return {"playlists": list(self._iter_user_playlists())}
+
+    def iter_all_user_playlists(self):
+        """Yields users playlists as PlaylistRecords, fetching a page at a time"""
+        for playlist in self._iter_user_playlists():
+            yield PlaylistRecord(playlist["id"],
+                                 playlist["name"],
+                                 playlist["owner"]["display_name"],
+                                 playlist["snapshot_id"])
+
+    def _iter_user_playlists(self):
+        """Yields the playlist objects of the Web API"""
         offset = 0
+        limit = 50
 
         while True:
             resp = self.authorized_get_request(
                 "https://api.spotify.com/v1/me/playlists",
                 params={"limit": limit, "offset": offset}).json()
             offset += limit
-            playlists.extend(resp["items"])
+            yield from resp["items"]
 
             if len(resp["items"]) < limit:
                 break
 
-        return {"playlists": playlists}
-
     def get_playlist_songs(self, playlist_id):
         """returns list of songs in a playlist"""
+        return [song.to_dict() for song in self.iter_playlist_songs(playlist_id)]
+
+    def iter_playlist_songs(self, playlist_id):
+        """Yields the songs in a playlist, fetching a page at a time"""
         offset = 0
         limit = 100
-        audios = []
 
         while True:
+            # Only the fields used are requested, pages are a lot smaller
             resp = self.authorized_get_request(
                 f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks",
-                params={"limit": limit, "offset": offset},
+                params={"limit": limit, "offset": offset,
+                        "fields": "items(added_at,track(id,name,artists(id,name)))"},
             ).json()
             offset += limit
             for song in resp["items"]:
                 if song["track"] is not None:
-                    audios.append({"id": song["track"]["id"],
-                                   "name": song["track"]["name"],
-                                   "artist": song["track"]["artists"][0]["name"]})
+                    yield TrackRecord(song["track"]["id"],
+                                      song["track"]["name"],
+                                      song["track"]["artists"][0]["name"],
+                                      song["added_at"],
+                                      tuple(artist["id"] for artist in song["track"]["artists"]))
 
             if len(resp["items"]) < limit:
                 break
-        return audios
 
     def get_playlist_info(self, playlist_id):
         """Returns information scraped from playlist"""
         resp = self.authorized_get_request(
-            f"https://api.spotify.com/v1/playlists/{playlist_id}?fields=name,owner(display_name)&market=from_token"
+            f"https://api.spotify.com/v1/playlists/{playlist_id}?fields=name,owner(display_name),snapshot_id"
+            "&market=from_token"
         ).json()
         return {
             "name": resp["name"].strip(),
             "owner": resp["owner"]["display_name"].strip(),
-            "id": playlist_id}
+            "id": playlist_id,
+            "snapshot_id": resp["snapshot_id"]}
 
     def get_album_songs(self, album_id):
         """Returns album tracklist"""
@@ -451,7 +1122,10 @@ class ZSpotifyApi:
 
     def get_liked_tracks(self):
         """Returns user's saved tracks"""
-        songs = []
+        return [song.to_dict() for song in self.iter_liked_tracks()]
+
+    def iter_liked_tracks(self):
+        """Yields user's saved tracks, newest first, fetching a page at a time"""
         offset = 0
         limit = 50
 
@@ -461,16 +1135,15 @@ class ZSpotifyApi:
                 params={"limit": limit, "offset": offset}).json()
             offset += limit
             for song in resp["items"]:
-                songs.append({'id': song["track"]["id"],
-                              'name': song["track"]["name"],
-                              'artist': song["track"]["artists"][0]["name"]})
-            # songs.extend(resp["items"])
+                yield TrackRecord(song["track"]["id"],
+                                  song["track"]["name"],
+                                  song["track"]["artists"][0]["name"],
+                                  song["added_at"],
+                                  tuple(artist["id"] for artist in song["track"]["artists"]))
 
             if len(resp["items"]) < limit:
                 break
 
-        return songs
-
     def get_artist_info(self, artist_id):
         """ Retrieves metadata for downloaded songs """
 
@@ -499,6 +1172,10 @@ class ZSpotifyApi:
         )
         if not info:
             return None
+        return self.parse_episode_info(episode_id_str, info)
+
+    def parse_episode_info(self, episode_id_str, info):
+        """Returns the metadata of an episode object from the episodes endpoint"""
         sum_total = []
         for sum_px in info['images']:
             sum_total.append(sum_px['height'] + sum_px['width'])
@@ -526,11 +1203,30 @@ class ZSpotifyApi:
                 'audio_number': None,
                 'scraped_episode_id': scraped_episode_id,
                 'is_playable': is_playable,
-                'release_date': release_date}
+                'release_date': release_date,
+                'duration_ms': info["duration_ms"]}
+
+    def get_episode_infos(self, episode_ids):
+        """Retrieves metadata for many episodes, 50 per request
+
+        Returns a dict of episode id to metadata, None for the episodes that
+        could not be found"""
+        infos = {}
+        for i in range(0, len(episode_ids), 50):
+            batch = episode_ids[i:i + 50]
+            resp = self.authorized_get_request(
+                "https://api.spotify.com/v1/episodes",
+                params={"ids": ",".join(batch), "market": "from_token"}).json()
+            for episode_id, info in zip(batch, resp["episodes"]):
+                infos[episode_id] = self.parse_episode_info(episode_id, info) if info else None
+        return infos
 
     def get_show_episodes(self, show_id_str):
         """returns episodes of a show"""
-        episodes = []
+        return list(self.iter_show_episodes(show_id_str))
+
+    def iter_show_episodes(self, show_id_str):
+        """Yields episodes of a show, newest first, fetching a page at a time"""
         offset = 0
         limit = 50
 
@@ -541,16 +1237,14 @@ class ZSpotifyApi:
             ).json()
             offset += limit
             for episode in resp["items"]:
-                episodes.append({"id": episode["id"],
-                                 "name": episode["name"],
-                                 "release_date": episode["release_date"]})
-                # episodes.append(episode["id"])
+                if episode is not None:
+                    yield {"id": episode["id"],
+                           "name": episode["name"],
+                           "release_date": episode["release_date"]}
 
             if len(resp["items"]) < limit:
                 break
 
-        return episodes
-
     def get_show_info(self, show_id_str):
         """returns show info"""
         resp = self.authorized_get_request(
@@ -562,63 +1256,129 @@ class ZSpotifyApi:
                 'total_episodes': resp["total_episodes"]}
 
     # Functions directly related to downloading stuff
-    def download_audio(self, track_id, output_path, make_dirs=True):
-        """Downloads raw song audio from Spotify"""
-        # TODO: ADD disc_number IF > 1
+    def load_stream(self, track_id, audio_type=None):
+        """Opens the librespot audio stream of a track or episode
+
+        audio_type is "track" or "episode", when it is not known a track is
+        tried first."""
+        from librespot.audio.decoders import VorbisOnlyAudioQuality
+        from librespot.core import ApiClient
+        from librespot.metadata import TrackId, EpisodeId
+        if audio_type == "episode":
+            return self.session.content_feeder().load(
+                EpisodeId.from_base62(track_id), VorbisOnlyAudioQuality(self.quality), False, None
+            )
         try:
-            # print("###   FOUND SONG:", song_name, "   ###")
-            try:
-                _track_id = TrackId.from_base62(track_id)
-                stream = self.session.content_feeder().load(
+            _track_id = TrackId.from_base62(track_id)
+            return self.session.content_feeder().load(
+                _track_id, VorbisOnlyAudioQuality(self.quality), False, None
+            )
+        except Exception as e:
+            if isinstance(e, ApiClient.StatusCodeException) and audio_type is None:
+                _track_id = EpisodeId.from_base62(track_id)
+                return self.session.content_feeder().load(
                     _track_id, VorbisOnlyAudioQuality(self.quality), False, None
                 )
+            else:
+                raise e
+
+    def prefetch_streams(self, track_ids, audio_type=None):
+        """Opens the streams of the next tracks or episodes in the background
+
+        The audio key exchange and CDN lookup then happen while the current
+        download is still streaming. Streams not downloaded within stream_ttl
+        seconds are discarded, their CDN urls may have expired."""
+        from concurrent.futures import ThreadPoolExecutor
+        self.expire_streams()
+        with self._stream_lock:
+            if self._stream_executor is None:
+                self._stream_executor = ThreadPoolExecutor(max_workers=2)
+            for track_id in track_ids:
+                if track_id not in self.prefetched_streams:
+                    self.prefetched_streams[track_id] = (
+                        time.monotonic(),
+                        self._stream_executor.submit(self.load_stream, track_id, audio_type))
+
+    def take_stream(self, track_id, audio_type=None):
+        """Returns the prefetched stream of a track, opens it if there is none"""
+        with self._stream_lock:
+            opened_at, future = self.prefetched_streams.pop(track_id, (None, None))
+        if future is not None and time.monotonic() - opened_at < self.stream_ttl:
+            try:
+                return future.result()
             except Exception as e:
-                if isinstance(e, ApiClient.StatusCodeException):
-                    _track_id = EpisodeId.from_base62(track_id)
-                    stream = self.session.content_feeder().load(
-                        _track_id, VorbisOnlyAudioQuality(self.quality), False, None
-                    )
-                else:
-                    raise e
-
-            # print("###   DOWNLOADING RAW AUDIO   ###")
-
-            total_size = stream.input_stream.size
-            downloaded = 0
-            _CHUNK_SIZE = self.chunk_size
-            fail = 0
-            self.progress = {"track_id": track_id,
-                             "total": total_size,
-                             "downloaded": downloaded}
-
-            segments = []
-
-            while downloaded <= total_size:
-                data = stream.input_stream.stream().read(_CHUNK_SIZE)
-
-                downloaded += len(data)
-                segments.append(data)
-                self.progress["downloaded"] = downloaded
-                if (total_size - downloaded) < _CHUNK_SIZE:
-                    _CHUNK_SIZE = total_size - downloaded
-                if len(data) == 0:
-                    fail += 1
-                if fail > self.reintent_download:
-                    break
-
-            self.progress = False
-
-            # Create output directories
-            _dirs_path = output_path.parent
-            if make_dirs:
-                _dirs_path.mkdir(parents=True, exist_ok=True)
-            elif not _dirs_path.exists():
-                raise FileNotFoundError(
-                    f"Directory {str(_dirs_path)} does not exist")
-
-            # Save raw audio as BytesIO object and convert from there
-            audio_bytes = BytesIO(b"".join(segments))
-            self.convert_audio_format(audio_bytes, output_path)
+                print(f"Prefetching {track_id} failed, opening it again: {e}")
+        elif future is not None:
+            self.close_stream(future)
+        return self.load_stream(track_id, audio_type)
+
+    def expire_streams(self):
+        with self._stream_lock:
+            now = time.monotonic()
+            expired = [track_id for track_id, (opened_at, _) in self.prefetched_streams.items()
+                       if now - opened_at >= self.stream_ttl]
+            futures = [self.prefetched_streams.pop(track_id)[1] for track_id in expired]
+        for future in futures:
+            self.close_stream(future)
+
+    def discard_streams(self, track_ids):
+        """Closes the prefetched streams of tracks that will not be downloaded,
+        the executor is shut down once no prefetched stream is left"""
+        with self._stream_lock:
+            futures = [self.prefetched_streams.pop(track_id)[1] for track_id in track_ids
+                       if track_id in self.prefetched_streams]
+            executor = None
+            if not self.prefetched_streams:
+                executor, self._stream_executor = self._stream_executor, None
+        for future in futures:
+            # Streams not opened yet are not opened at all
+            future.cancel()
+            self.close_stream(future)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def close_stream(future):
+        """Closes a prefetched stream that will not be read"""
+        def close(done):
+            if not done.cancelled() and done.exception() is None:
+                done.result().input_stream.stream().close()
+
+        future.add_done_callback(close)
+
+    def request_ranges(self, stream, position):
+        """Requests the parallel_ranges chunks of a stream from position on
+
+        librespot only fetches the chunk being read, one range request at a
+        time. Requesting the next chunks ahead of the reads keeps several
+        range requests in flight, so a stream is not limited to the
+        throughput of a single CDN connection."""
+        internal = stream.input_stream.stream()
+        if self.parallel_ranges <= 1 or not hasattr(internal, "request_chunk_from_stream"):
+            return
+        # librespot requests again the chunks marked as requested ahead of
+        # the read position, which would fetch every chunk twice
+        internal.preload_ahead = 0
+        requested = internal.requested_chunks()
+        first = position // STREAM_CHUNK_SIZE
+        for index in range(first, min(internal.chunks(), first + self.parallel_ranges)):
+            if not requested[index]:
+                requested[index] = True
+                internal.request_chunk_from_stream(index)
+
+    def download_audio(self, track_id, output_path, make_dirs=True, tags=None, cover=None,
+                       audio_type=None):
+        """Downloads raw song audio from Spotify
+
+        Progress is reported in self.progress, so only one download can run
+        at a time, use download_many to download in parallel."""
+        # TODO: ADD disc_number IF > 1
+        self.progress = {}
+        try:
+            analysis = self._download_audio(track_id, output_path, make_dirs, tags, cover,
+                                            progress=self.progress, audio_type=audio_type)
+            if analysis is not None:
+                self.loudness[track_id] = analysis
 
             if not self.override_auto_wait:
                 time.sleep(self.anti_ban_wait_time)
@@ -628,63 +1388,219 @@ class ZSpotifyApi:
             print(e)
             print(track_id, output_path)
             return False
+        finally:
+            if self.progress.get("stats"):
+                self.stream_stats[track_id] = self.progress["stats"]
+            self.progress = False
 
-    def search(self, search_term):
-        """Searches Spotify's API for relevant data"""
+    @traced("download_audio")
+    def _download_audio(self, track_id, output_path, make_dirs=True, tags=None, cover=None,
+                        progress=None, sleep=time.sleep, audio_type=None):
+        """Downloads and converts a track or episode, raises if it fails
+
+        progress, if given, is a dict updated with the state ("loading",
+        "downloading", "converting", "done"), total and downloaded bytes,
+        throughput and stalled while the download runs, and the stats of the
+        stream once read. sleep is called to wait after a stall. audio_type
+        is "track" or "episode" if known. Returns the loudness analysis if
+        replaygain is enabled."""
+        if progress is None:
+            progress = {}
+        progress.update(track_id=track_id, state="loading")
+        stream = self.take_stream(track_id, audio_type)
+
+        total_size = stream.input_stream.size
+        reader = AdaptiveReader(total_size, self.chunk_size,
+                                max_stalls=self.reintent_download)
+        progress.update(total=total_size,
+                        downloaded=0,
+                        throughput=0.0,
+                        stalled=False,
+                        state="downloading")
+
+        segments = []
+
+        while not reader.done:
+            self.request_ranges(stream, reader.downloaded)
+            started = time.monotonic()
+            data = stream.input_stream.stream().read(reader.next_chunk_size())
+            reader.record(len(data), time.monotonic() - started)
+
+            segments.append(data)
+            progress.update(downloaded=reader.downloaded,
+                            throughput=reader.throughput,
+                            stalled=reader.stalled)
+            if reader.stalled and not reader.done:
+                sleep(reader.backoff())
+            else:
+                delay = self.bandwidth.reserve(len(data))
+                if delay:
+                    sleep(delay)
+
+        progress.update(stats=reader.stats(), state="converting")
+        if not reader.complete:
+            raise RuntimeError(
+                f"Stream stalled after {reader.downloaded} of {total_size} bytes")
+
+        self.create_output_dirs(output_path, make_dirs)
+
+        # Save raw audio as BytesIO object and convert from there
+        audio_bytes = BytesIO(b"".join(segments))
+        analysis = self.convert_audio_format(audio_bytes, output_path, tags, cover)
+        progress["state"] = "done"
+        return analysis
+
+    def download_many(self, ids, output_paths, parallelism=4, make_dirs=True,
+                      tags=None, covers=None, audio_type=None):
+        """Downloads tracks or episodes in parallel, safe to call from any thread
+
+        output_paths is a list of output paths in the order of ids, or a
+        function of the id returning its output path. tags and covers are
+        optional dicts of id to the tags and cover of convert_audio_format,
+        audio_type is "track" or "episode" if all the ids are of one type.
+        Returns a list of DownloadJob, their futures never raise: failures
+        are DownloadResult with ok False. Use completed() to get the results
+        in completion order:
+
+            for result in api.completed(api.download_many(ids, paths)):
+                print(result.id, result.ok, result.error)
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        ids = list(ids)
+        if callable(output_paths):
+            output_paths = [output_paths(track_id) for track_id in ids]
+        tags = tags or {}
+        covers = covers or {}
+
+        executor = ThreadPoolExecutor(max_workers=parallelism)
+        jobs = []
+        for track_id, output_path in zip(ids, output_paths):
+            progress = {"track_id": track_id, "state": "queued"}
+            future = executor.submit(self._download_job, track_id, output_path, make_dirs,
+                                     tags.get(track_id), covers.get(track_id), progress, audio_type)
+            jobs.append(DownloadJob(track_id, output_path, progress, future))
+        # Queued jobs still run, the workers exit once they are done
+        executor.shutdown(wait=False)
+        return jobs
+
+    @staticmethod
+    def completed(jobs):
+        """Yields the DownloadResult of jobs as they finish"""
+        from concurrent.futures import as_completed
+        for future in as_completed([job.future for job in jobs]):
+            yield future.result()
+
+    def _download_job(self, track_id, output_path, make_dirs, tags, cover, progress, audio_type):
+        started = time.monotonic()
+        try:
+            analysis = self._download_audio(track_id, output_path, make_dirs, tags, cover,
+                                            progress=progress, audio_type=audio_type)
+            return DownloadResult(track_id, output_path, True, None, analysis,
+                                  progress.get("stats"), time.monotonic() - started)
+        except Exception as e:
+            progress["state"] = "failed"
+            return DownloadResult(track_id, output_path, False, e, None,
+                                  progress.get("stats"), time.monotonic() - started)
+        finally:
+            if not self.override_auto_wait:
+                time.sleep(self.anti_ban_wait_time)
 
+    def search(self, search_term, offset=0, types=SEARCH_TYPES, prefetch=True):
+        """Searches Spotify's API for relevant data
+
+        Results are cached for search_cache_ttl seconds, keyed by the query,
+        types and page. With prefetch the next page is fetched in the
+        background, so paging through results does not wait for the API."""
+        key = (search_term, types, offset, self.limit)
+        results = self._search_future(key).result()
+        if prefetch:
+            self._search_future((search_term, types, offset + self.limit, self.limit))
+        return results
+
+    def _search_future(self, key):
+        """Returns the cached future of a search page, fetching it if needed"""
+        from concurrent.futures import ThreadPoolExecutor
+        with self._search_lock:
+            if self._search_executor is None:
+                self._search_executor = ThreadPoolExecutor(max_workers=2)
+            cached = self.search_cache.get(key)
+            if cached is not None:
+                timestamp, future = cached
+                expired = time.time() - timestamp > self.search_cache_ttl
+                failed = future.done() and future.exception() is not None
+                if not expired and not failed:
+                    return future
+            future = self._search_executor.submit(self._search, *key)
+            self.search_cache[key] = (time.time(), future)
+            return future
+
+    def _search(self, search_term, types, offset, limit):
         resp = self.authorized_get_request(
             "https://api.spotify.com/v1/search",
             params={
-                "limit": self.limit,
-                "offset": "0",
+                "limit": limit,
+                "offset": offset,
                 "q": search_term,
-                "type": "track,album,playlist,artist"
+                "type": types,
+                "market": "from_token"
             }
-        )
+        ).json()
+
+        def items(kind):
+            # Spotify sometimes returns null items
+            return [item for item in resp.get(kind, {}).get("items", []) if item is not None]
+
         ret_tracks = []
-        tracks = resp.json()["tracks"]["items"]
-        if len(tracks) > 0:
-            for track in tracks:
-                if track["explicit"]:
-                    explicit = "[E]"
-                else:
-                    explicit = ""
-                ret_tracks.append({'id': track['id'], 'name': explicit + track["name"],
-                                   "artists": ','.join([artist['name'] for artist in track['artists']])})
+        for track in items("tracks"):
+            if track["explicit"]:
+                explicit = "[E]"
+            else:
+                explicit = ""
+            ret_tracks.append({'id': track['id'], 'name': explicit + track["name"],
+                               "artists": ','.join([artist['name'] for artist in track['artists']])})
+
         ret_albums = []
-        albums = resp.json()["albums"]["items"]
-        if len(albums) > 0:
-            for album in albums:
-                # print("==>",album,"\n")
-                _year = re.search("(\\d{4})", album["release_date"]).group(1)
-                ret_albums.append({'name': album['name'],
-                                   'year': _year,
-                                   'artists': ','.join([artist['name'] for artist in album['artists']]),
-                                   'total_tracks': album['total_tracks'],
-                                   'id': album['id']})
+        for album in items("albums"):
+            _year = re.search("(\\d{4})", album["release_date"]).group(1)
+            ret_albums.append({'name': album['name'],
+                               'year': _year,
+                               'artists': ','.join([artist['name'] for artist in album['artists']]),
+                               'total_tracks': album['total_tracks'],
+                               'id': album['id']})
 
         ret_playlists = []
-        playlists = resp.json()["playlists"]["items"]
-        for playlist in playlists:
+        for playlist in items("playlists"):
             ret_playlists.append({'name': playlist['name'],
                                   'owner': playlist['owner']['display_name'],
                                   'total_tracks': playlist['tracks']['total'],
                                   'id': playlist['id']})
 
         ret_artists = []
-        artists = resp.json()["artists"]["items"]
-        for artist in artists:
+        for artist in items("artists"):
             ret_artists.append({'name': artist['name'],
                                 'genres': '/'.join(artist['genres']),
                                 'id': artist['id']})
 
-        # TODO: Add search in episodes and shows
-
-        if len(ret_tracks) + len(ret_albums) + \
-                len(ret_playlists) + len(ret_artists) == 0:
+        ret_shows = []
+        for show in items("shows"):
+            ret_shows.append({'name': show['name'],
+                              'publisher': show['publisher'],
+                              'total_episodes': show['total_episodes'],
+                              'id': show['id']})
+
+        ret_episodes = []
+        for episode in items("episodes"):
+            ret_episodes.append({'name': episode['name'],
+                                 'release_date': episode['release_date'],
+                                 'id': episode['id']})
+
+        if len(ret_tracks) + len(ret_albums) + len(ret_playlists) + \
+                len(ret_artists) + len(ret_shows) + len(ret_episodes) == 0:
             return None
         else:
             return {'tracks': ret_tracks,
                     'albums': ret_albums,
                     'playlists': ret_playlists,
-                    'artists': ret_artists}
+                    'artists': ret_artists,
+                    'shows': ret_shows,
+                    'episodes': ret_episodes}
@@ -0,0 +1,286 @@
+try:
+    from .zspotify_api import AdaptiveReader, PlaylistRecord, TrackRecord, ZSpotifyApi
+except ImportError:
+    from zspotify_api import AdaptiveReader, PlaylistRecord, TrackRecord, ZSpotifyApi
+
+from io import BytesIO
+
+import asyncio
+import time
+
+
+class AsyncStream:
+    """Adapts a blocking librespot input stream to the event loop
+
+    Every read runs in the executor, so the loop is never blocked while
+    librespot waits for CDN chunks or decrypts them.
+    """
+
+    def __init__(self, stream, executor=None):
+        self.stream = stream
+        self.executor = executor
+        self.size = stream.input_stream.size
+
+    async def read(self, size):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.stream.input_stream.stream().read, size)
+
+
+class AsyncZSpotifyApi:
+    """asyncio variant of ZSpotifyApi
+
+    Web API calls go through a single aiohttp session, so hundreds of
+    metadata requests can be in flight from one event loop. Login, audio
+    streaming and conversion still use librespot and pydub, which are
+    blocking, and run in the default executor.
+
+    Usage:
+        async with AsyncZSpotifyApi(api) as zs:
+            async for song in zs.iter_playlist_songs(playlist_id):
+                ...
+    """
+
+    def __init__(self, api=None, max_concurrency=100, **kwargs):
+        self.api = api if api is not None else ZSpotifyApi(**kwargs)
+        self.max_concurrency = max_concurrency
+        self._http = None
+        self._semaphore = None
+        self._token_lock = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        """Creates the aiohttp session, aiohttp is an optional dependency"""
+        try:
+            import aiohttp
+        except ImportError as e:
+            raise ImportError(
+                "AsyncZSpotifyApi requires aiohttp, install it with "
+                "'pip install zspotify[async]'") from e
+        if self._http is None:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency))
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._token_lock = asyncio.Lock()
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    async def login(self, username=None, password=None):
+        """Authenticates with Spotify, see ZSpotifyApi.login"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.api.login, username, password)
+
+    async def authorized_get_request(self, url, params=None):
+        """Makes a request to the Spotify API and returns the decoded json
+
+        Retries follow the retry_policy of the wrapped api, which is shared
+        with its threads."""
+        import aiohttp
+
+        if self._http is None:
+            await self.open()
+        policy = self.api.retry_policy
+        endpoint = policy.endpoint_class(url)
+        loop = asyncio.get_running_loop()
+        refreshed = False
+        for attempt in range(policy.max_retries + 1):
+            delay = policy.delay(endpoint)
+            if delay:
+                await asyncio.sleep(delay)
+            token = self.api.token
+            try:
+                async with self._semaphore:
+                    async with self._http.get(
+                            url,
+                            params=params,
+                            timeout=aiohttp.ClientTimeout(total=policy.timeout),
+                            headers={"Authorization": f"Bearer {token}"}) as response:
+                        if response.status == 401 and not refreshed:
+                            refreshed = True
+                        elif response.status == 429:
+                            policy.throttle(endpoint, policy.retry_after(response, attempt))
+                            continue
+                        elif response.status >= 500:
+                            policy.failure(endpoint)
+                            await asyncio.sleep(policy.backoff(attempt))
+                            continue
+                        else:
+                            policy.success(endpoint)
+                            response.raise_for_status()
+                            await self.limit_api_bandwidth(len(await response.read()))
+                            return await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                policy.failure(endpoint)
+                await asyncio.sleep(policy.backoff(attempt))
+                continue
+            # One coroutine logs in again, the others find the new token
+            async with self._token_lock:
+                await loop.run_in_executor(None, self.api.refresh_token, token)
+        raise RuntimeError(f"Connection Error: Too many retries requesting {endpoint}")
+
+    async def paginate(self, url, limit, params=None):
+        """Yields the items of a paginated endpoint, one page at a time"""
+        offset = 0
+        while True:
+            resp = await self.authorized_get_request(
+                url, params={**(params or {}), "limit": limit, "offset": offset})
+            offset += limit
+            for item in resp["items"]:
+                yield item
+
+            if len(resp["items"]) < limit:
+                break
+
+    # INFO
+    async def get_audio_info(self, track_id, get_genres=False):
+        """Retrieves metadata for downloaded songs"""
+        infos = await self.get_audio_infos([track_id], get_genres)
+        return infos[track_id]
+
+    async def get_audio_infos(self, track_ids, get_genres=False):
+        """Retrieves metadata for many songs, 50 per request, concurrently
+
+        Returns a dict of track id to metadata, None for the tracks that could
+        not be found, like ZSpotifyApi.get_audio_infos"""
+        batches = [track_ids[i:i + 50] for i in range(0, len(track_ids), 50)]
+        responses = await asyncio.gather(*[
+            self.authorized_get_request(
+                "https://api.spotify.com/v1/tracks",
+                params={"ids": ",".join(batch), "market": "from_token"})
+            for batch in batches])
+        if get_genres:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.api.get_artist_genres, [
+                artist["id"] for resp in responses for track in resp["tracks"] if track
+                for artist in track["artists"]])
+
+        infos = {}
+        for batch, resp in zip(batches, responses):
+            for track_id, track in zip(batch, resp["tracks"]):
+                infos[track_id] = self.api.parse_audio_info(track_id, track, get_genres) if track else None
+        return infos
+
+    async def iter_all_user_playlists(self):
+        """Yields the users playlists"""
+        async for playlist in self.paginate(
+                "https://api.spotify.com/v1/me/playlists", 50):
+            yield PlaylistRecord(playlist["id"],
+                                 playlist["name"],
+                                 playlist["owner"]["display_name"],
+                                 playlist["snapshot_id"])
+
+    async def iter_playlist_songs(self, playlist_id):
+        """Yields the songs in a playlist"""
+        async for song in self.paginate(
+                f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks", 100,
+                params={"fields": "items(added_at,track(id,name,artists(id,name)))"}):
+            if song["track"] is not None:
+                yield self.track_record(song)
+
+    async def iter_album_songs(self, album_id):
+        """Yields the album tracklist"""
+        async for song in self.paginate(
+                f"https://api.spotify.com/v1/albums/{album_id}/tracks", 50,
+                params={"include_groups": "album,compilation"}):
+            yield {"id": song["id"],
+                   "name": song["name"],
+                   "number": song["track_number"],
+                   "disc_number": song["disc_number"]}
+
+    async def iter_liked_tracks(self):
+        """Yields the user's saved tracks"""
+        async for song in self.paginate("https://api.spotify.com/v1/me/tracks", 50):
+            yield self.track_record(song)
+
+    @staticmethod
+    def track_record(song):
+        """Returns the TrackRecord of a playlist or saved track item, like
+        the listings of ZSpotifyApi"""
+        return TrackRecord(song["track"]["id"],
+                           song["track"]["name"],
+                           song["track"]["artists"][0]["name"],
+                           song["added_at"],
+                           tuple(artist["id"] for artist in song["track"]["artists"]))
+
+    async def iter_show_episodes(self, show_id_str):
+        """Yields the episodes of a show"""
+        async for episode in self.paginate(
+                f"https://api.spotify.com/v1/shows/{show_id_str}/episodes", 50):
+            yield {"id": episode["id"],
+                   "name": episode["name"],
+                   "release_date": episode["release_date"]}
+
+    async def get_cover(self, image_url):
+        """Returns the bytes of a cover image"""
+        if self._http is None:
+            await self.open()
+        async with self._semaphore:
+            async with self._http.get(image_url) as response:
+                cover = await response.read()
+        await self.limit_api_bandwidth(len(cover))
+        return cover
+
+    async def limit_api_bandwidth(self, size):
+        """Waits for size bytes of API or cover traffic to fit max_api_bandwidth"""
+        delay = self.api.api_bandwidth.reserve(size)
+        if delay:
+            await asyncio.sleep(delay)
+
+    # Functions directly related to downloading stuff
+    async def download_audio(self, track_id, output_path, make_dirs=True, tags=None, cover=None,
+                             audio_type=None):
+        """Downloads raw song audio from Spotify, the loudness analysis is
+        kept in api.loudness like ZSpotifyApi.download_audio does"""
+        loop = asyncio.get_running_loop()
+        try:
+            stream = AsyncStream(
+                await loop.run_in_executor(None, self.api.take_stream, track_id, audio_type))
+
+            reader = AdaptiveReader(stream.size, self.api.chunk_size,
+                                    max_stalls=self.api.reintent_download)
+            segments = []
+
+            while not reader.done:
+                self.api.request_ranges(stream.stream, reader.downloaded)
+                started = time.monotonic()
+                data = await stream.read(reader.next_chunk_size())
+                reader.record(len(data), time.monotonic() - started)
+
+                segments.append(data)
+                if reader.stalled and not reader.done:
+                    await asyncio.sleep(reader.backoff())
+                else:
+                    delay = self.api.bandwidth.reserve(len(data))
+                    if delay:
+                        await asyncio.sleep(delay)
+
+            self.api.stream_stats[track_id] = reader.stats()
+            if not reader.complete:
+                raise RuntimeError(
+                    f"Stream stalled after {reader.downloaded} of {stream.size} bytes")
+
+            self.api.create_output_dirs(output_path, make_dirs)
+
+            audio_bytes = BytesIO(b"".join(segments))
+            analysis = await loop.run_in_executor(
+                None, self.api.convert_audio_format, audio_bytes, output_path, tags, cover)
+            if analysis is not None:
+                self.api.loudness[track_id] = analysis
+
+            if not self.api.override_auto_wait:
+                await asyncio.sleep(self.api.anti_ban_wait_time)
+            return True
+        except Exception as e:
+            print("###   download_track - FAILED TO DOWNLOAD   ###")
+            print(e)
+            print(track_id, output_path)
+            return False